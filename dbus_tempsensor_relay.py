@@ -4,13 +4,18 @@
 from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GLib
 from enum import Enum
+from array import array
+from collections import deque
+from heapq import heappush, heappop, heapify
+from math import exp
+from time import monotonic, perf_counter, time
 import dbus
 import dbus.service
 import os
-import argparse
+import resource
+import struct
 import sys
 import os
-import re
 
 # Victron packages
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), './ext/velib_python'))
@@ -23,39 +28,721 @@ from logger import setup_logging
 
 softwareVersion = '1.6'
 
+# NumPy is only imported when the batch evaluator is used
+numpy = None
+
+def load_numpy():
+	global numpy
+	if numpy is None:
+		try:
+			import numpy
+		except ImportError:
+			return None
+	return numpy
+
 READ_RETRIES = 300
 
+# Sensors are evaluated when their temperature changes, every FULL_EVALUATION_TICKS
+# timer ticks all of them are evaluated again regardless
+FULL_EVALUATION_TICKS = 60
+TEMPERATURE_PATHS = ('/Temperature', '/Dc/0/Temperature', '/System/MinCellTemperature')
+
+# Statistics published under /Debug are updated every STATS_INTERVAL seconds, the durations
+# of the last STATS_WINDOW ticks and of the last STATS_WINDOW evaluations of a changed
+# sensor are kept
+STATS_INTERVAL = 10
+STATS_WINDOW = 600
+
+# Relay instances looked for on com.victronenergy.settings and com.victronenergy.system
+RELAY_INSTANCES = range(0, 8)
+
+# Settings changed through the service are written to localsettings SETTINGS_FLUSH_DELAY ms
+# after the first change, all changes made in that window are written together
+SETTINGS_FLUSH_DELAY = 500
+
+# Relay writes are asynchronous. A write without reply after RELAY_WRITE_TIMEOUT ms is
+# considered failed, failed writes are retried RELAY_WRITE_RETRIES times every
+# RELAY_RETRY_DELAY ms
+RELAY_WRITE_TIMEOUT = 5000
+RELAY_WRITE_RETRIES = 3
+RELAY_RETRY_DELAY = 1000
+
+# The state of the sensors is saved to CACHE_FILE at most every CACHE_INTERVAL seconds and
+# restored on start when not older than CACHE_MAX_AGE seconds. The file is kept on a volatile
+# file system, it only has to survive a restart of the service, not a reboot.
+CACHE_FILE = '/run/dbus-tempsensor-relay.cache'
+CACHE_INTERVAL = 60
+CACHE_MAX_AGE = 300
+
+# Number of virtual sensors that can be configured, each one combines the temperatures
+# of a group of sensors
+VIRTUAL_SENSORS = 4
+
+# The trend of a sensor is fitted over the readings of the last TREND_WINDOW seconds, it
+# needs at least TREND_MIN_SAMPLES readings spanning TREND_MIN_SPAN seconds
+TREND_WINDOW = 600
+TREND_MIN_SAMPLES = 3
+TREND_MIN_SPAN = 60
+
+# The history of each sensor keeps HISTORY_LENGTH intervals of HISTORY_INTERVAL seconds
+HISTORY_INTERVAL = 60
+HISTORY_LENGTH = 1440
+
+# Buffered trace records are flushed to the file every TRACE_FLUSH_INTERVAL seconds
+TRACE_FLUSH_INTERVAL = 10
+
+def relay_function_path(instance):
+	# The function of the first relay is not stored under its instance
+	if instance == 0:
+		return '/Settings/Relay/Function'
+	return '/Settings/Relay/{}/Function'.format(instance)
+
+def relay_state_path(instance):
+	return '/Relay/{}/State'.format(instance)
+
+# Thresholds are kept as integers in hundredths of a degree
+def centidegrees(value):
+	return int(round(value * 100))
+
+# A reading is compared against them unrounded, so that 29.996 stays below 30. Rounding
+# to 1e-6 only drops the error of the multiplication, 0.29 * 100 is 28.999999999999996.
+def reading_centidegrees(value):
+	return round(value * 100, 6)
+
+# Set value, clear value, relay and state of each condition of a sensor. The set and
+# clear values are in centidegrees.
+class ConditionTable(object):
+	__slots__ = ('setvalues', 'clearvalues', 'relays', 'active')
+
+	def __init__(self, size):
+		self.setvalues = array('i', [0]) * size
+		self.clearvalues = array('i', [0]) * size
+		self.relays = array('i', [-1]) * size
+		self.active = array('b', [0]) * size
+
+	def __len__(self):
+		return len(self.relays)
+
+	def release(self):
+		for i in range(len(self.active)):
+			self.active[i] = 0
+
+
+# Per sensor filter stage in front of the hysteresis. EMA and MEDIAN smooth the
+# temperature, DWELL keeps the temperature but only accepts a new condition state once
+# it held for the window. The window is the time constant or the dwell time in seconds,
+# or the number of readings of the median, at most MEDIAN_MAX.
+class TemperatureFilter(object):
+	NONE = 0
+	EMA = 1
+	MEDIAN = 2
+	DWELL = 3
+	MEDIAN_MAX = 15
+
+	__slots__ = ('mode', 'window', 'value', 'time', 'samples', 'count', 'since')
+
+	def __init__(self, mode, window, conditions):
+		self.mode = mode
+		self.window = max(window, 1)  # Whatever the setting says, 0 would divide by zero
+		self.value = None
+		self.time = None
+		self.samples = array('d', [0]) * min(self.window, self.MEDIAN_MAX) if mode == self.MEDIAN else None
+		self.count = 0
+		self.since = array('d', [-1]) * conditions if mode == self.DWELL else None
+
+	# Returns the filtered temperature, an invalid reading starts the filter over. The
+	# reading is also passed on every tick, new tells whether it changed since the last
+	# call. EMA follows the time, the median only takes new readings.
+	def update(self, temperature, now, new=True):
+		if temperature is None:
+			self.value = None
+			self.count = 0
+			return None
+		if self.mode == self.EMA:
+			if self.value is None:
+				self.value = temperature
+			else:
+				self.value += (1 - exp(-(now - self.time) / self.window)) * (temperature - self.value)
+			self.time = now
+			return self.value
+		if self.mode == self.MEDIAN:
+			if not new and self.count:
+				return self.value
+			samples = self.samples
+			samples[self.count % len(samples)] = temperature
+			self.count += 1
+			valid = sorted(samples[:self.count]) if self.count < len(samples) else sorted(samples)
+			self.value = valid[len(valid) // 2]
+			return self.value
+		return temperature
+
+	# Whether condition i may take its new state, with DWELL a change has to hold
+	# for the window first
+	def settled(self, i, changed, now):
+		if self.since is None:
+			return True
+		if not changed:
+			self.since[i] = -1
+			return True
+		if self.since[i] < 0:
+			self.since[i] = now
+		if now - self.since[i] < self.window:
+			return False
+		self.since[i] = -1
+		return True
+
+
+# Least squares fit of the temperature over the readings of the last window seconds,
+# kept up to date with running sums. Times are taken relative to an origin that moves
+# along every few windows, so that the sums keep their precision.
+class TemperatureTrend(object):
+	def __init__(self, lead, window=TREND_WINDOW):
+		self.lead = lead  # Seconds ahead the temperature is projected
+		self.window = window
+		self.samples = deque()  # (time, temperature)
+		self.origin = None
+		self._sums()
+
+	def _sums(self):
+		self.sx = self.sy = self.sxx = self.sxy = 0.0
+		for t, y in self.samples:
+			self._add(t - self.origin, y, 1)
+
+	def _add(self, x, y, sign):
+		self.sx += sign * x
+		self.sy += sign * y
+		self.sxx += sign * x * x
+		self.sxy += sign * x * y
+
+	# An invalid reading starts the fit over
+	def update(self, now, temperature):
+		samples = self.samples
+		if temperature is None:
+			samples.clear()
+			self.origin = None
+			self._sums()
+			return
+		if self.origin is None or now - self.origin > 8 * self.window:
+			self.origin = now
+			self._sums()
+		samples.append((now, temperature))
+		self._add(now - self.origin, temperature, 1)
+		while samples[0][0] < now - self.window:
+			t, y = samples.popleft()
+			self._add(t - self.origin, y, -1)
+
+	# Degrees per second, None while there are too few readings
+	def slope(self):
+		samples = self.samples
+		n = len(samples)
+		if n < TREND_MIN_SAMPLES or samples[-1][0] - samples[0][0] < TREND_MIN_SPAN:
+			return None
+		d = n * self.sxx - self.sx * self.sx
+		if d <= 0:
+			return None
+		return (n * self.sxy - self.sx * self.sy) / d
+
+	# Temperature expected lead seconds after the last reading, None when unknown
+	def projected(self):
+		slope = self.slope()
+		if slope is None:
+			return None
+		return self.samples[-1][1] + slope * self.lead
+
+
+# Minimum, maximum or mean of the temperatures of a group of services, kept up to date
+# one reading at a time. Values are kept in centidegrees, so that the running sum of
+# the mean does not drift. Minimum and maximum use a heap of which outdated entries
+# are dropped lazily.
+class VirtualSensor(object):
+	NONE = 0
+	MIN = 1
+	MAX = 2
+	MEAN = 3
+
+	def __init__(self, function, members):
+		self.function = function
+		self.members = members  # Sensor ids
+		self.values = {}  # Service name -> temperature of the members with a valid reading
+		self.total = 0
+		self.heap = []  # (temperature, or its negative for MAX, service name)
+
+	def update(self, service, temperature):
+		old = self.values.pop(service, None)
+		if old is not None:
+			self.total -= old
+		if temperature is None:
+			return
+		value = centidegrees(temperature)
+		self.values[service] = value
+		self.total += value
+		if self.function != self.MEAN:
+			heappush(self.heap, (value if self.function == self.MIN else -value, service))
+			if len(self.heap) > 4 * len(self.values) + 16:
+				self.heap = [(v if self.function == self.MIN else -v, k) for k, v in self.values.items()]
+				heapify(self.heap)
+
+	def value(self):
+		if not self.values:
+			return None
+		if self.function == self.MEAN:
+			return self.total / len(self.values) / 100.0
+		heap = self.heap
+		while True:
+			key, service = heap[0]
+			value = key if self.function == self.MIN else -key
+			if self.values.get(service) == value:
+				return value / 100.0
+			heappop(heap)
+
+
+# Keeps the conditions of all sensors in flat parallel arrays, so that a full evaluation
+# is done in one batched step. The ConditionTable of each sensor is re-pointed to a
+# slice of these arrays. Uses NumPy when available and the array module otherwise.
+class BatchEvaluator(object):
+	NUMPY_TYPES = {'d': 'float64', 'i': 'int32', 'b': 'int8'}
+
+	def __init__(self, use_numpy=True):
+		self.numpy = load_numpy() if use_numpy else None
+		self.attach([])
+
+	def _alloc(self, typecode, size, value=0):
+		if self.numpy is not None:
+			return self.numpy.full(size, value, dtype=self.NUMPY_TYPES[typecode])
+		return array(typecode, [value]) * size
+
+	def _view(self, a, start, end):
+		if self.numpy is not None:
+			return a[start:end]
+		return memoryview(a)[start:end]
+
+	# sensors is a list of (service name, ConditionTable)
+	def attach(self, sensors):
+		rows = sum(len(table) for service, table in sensors)
+		self.setvalues = self._alloc('i', rows)
+		self.clearvalues = self._alloc('i', rows)
+		self.relays = self._alloc('i', rows, -1)
+		self.active = self._alloc('b', rows)
+		self.owners = self._alloc('i', rows)
+		self.temperatures = self._alloc('d', len(sensors), float('nan'))
+		self.evaluate = self._alloc('b', len(sensors))
+		self.services = []
+
+		offset = 0
+		for i, (service, table) in enumerate(sensors):
+			end = offset + len(table)
+			for name in ConditionTable.__slots__:
+				view = self._view(getattr(self, name), offset, end)
+				view[:] = getattr(table, name)
+				setattr(table, name, view)
+			for row in range(offset, end):
+				self.owners[row] = i
+			self.services.append(service)
+			offset = end
+
+	# Update the active flags of the sensors flagged in evaluate, using the temperatures
+	# in centidegrees (NaN when invalid). configured holds, per relay instance, whether it is ours to drive.
+	# Returns per relay instance whether any condition wants it closed.
+	def update(self, configured):
+		if self.numpy is not None:
+			return self._update_numpy(configured)
+		return self._update_array(configured)
+
+	def _update_numpy(self, configured):
+		np = self.numpy
+		relays = self.relays
+		known = (relays >= 0) & (relays < len(configured))
+		relayok = np.asarray(configured, dtype=bool)[np.where(known, relays, 0)] & known
+		temperatures = self.temperatures[self.owners]
+		setvalues = self.setvalues
+		clearvalues = self.clearvalues
+		active = self.active.astype(bool)
+
+		# Same as _inRange, comparisons against NaN are false
+		inRange = np.where(setvalues > clearvalues,
+			(temperatures >= setvalues) | (active & (temperatures > clearvalues)),
+			(temperatures <= setvalues) | (active & (temperatures < clearvalues)))
+		rows = self.evaluate[self.owners].astype(bool) & (relays >= 0)
+		self.active[rows] = (inRange & relayok)[rows]
+
+		states = np.zeros(len(configured), dtype=bool)
+		states[relays[known & self.active.astype(bool)]] = True
+		return states
+
+	def _update_array(self, configured):
+		count = len(configured)
+		states = [False] * count
+		temperatures = self.temperatures
+		evaluate = self.evaluate
+		owners = self.owners
+		setvalues = self.setvalues
+		clearvalues = self.clearvalues
+		active = self.active
+		for i, r in enumerate(self.relays):
+			if r < 0:
+				continue
+			if evaluate[owners[i]]:
+				t = temperatures[owners[i]]
+				a = active[i]
+				if t != t:
+					inRange = False
+				elif setvalues[i] > clearvalues[i]:
+					inRange = t >= setvalues[i] or (a and t > clearvalues[i])
+				else:
+					inRange = t <= setvalues[i] or (a and t < clearvalues[i])
+				active[i] = inRange and r < count and configured[r]
+			if active[i] and r < count:
+				states[r] = True
+		return states
+
+
+class Stats(object):
+	def __init__(self, now):
+		self.durations = deque(maxlen=STATS_WINDOW)  # Timer ticks
+		self.eventdurations = deque(maxlen=STATS_WINDOW)  # Evaluations of a changed sensor, up to the relay writes
+		self.evaluations = 0
+		self.since = now
+		self.switches = {}  # Relay instance -> number of switches
+		self.failedwrites = 0
+
+
+# Last known temperature and active conditions of each sensor. The timestamps are
+# monotonic, the clock and the volatile file system both start over on a reboot.
+class StateCache(object):
+	MAGIC = b'TSR1'
+	HEADER = struct.Struct('<4sdH')  # Magic, timestamp, conditions per sensor
+	ENTRY = struct.Struct('<Hd')  # Length of the service name, temperature (NaN when invalid)
+
+	def __init__(self, path, conditions):
+		self.path = path
+		self.conditions = conditions
+		self.entries = {}  # Service name -> (temperature, active flags)
+		self.timestamp = None
+		self.saved = None  # Entries as last written
+		self.savedat = None
+
+	def load(self):
+		try:
+			with open(self.path, 'rb') as f:
+				data = f.read()
+			magic, timestamp, conditions = self.HEADER.unpack_from(data)
+			if magic != self.MAGIC or conditions != self.conditions:
+				return
+			entries = {}
+			offset = self.HEADER.size
+			while offset < len(data):
+				length, temperature = self.ENTRY.unpack_from(data, offset)
+				offset += self.ENTRY.size
+				service = data[offset:offset + length].decode('utf-8')
+				offset += length
+				active = data[offset:offset + conditions]
+				offset += conditions
+				if len(active) != conditions:
+					return
+				entries[service] = (None if temperature != temperature else temperature, active)
+		except (OSError, struct.error, UnicodeDecodeError):
+			return
+		self.entries = entries
+		self.timestamp = timestamp
+
+	# Returns the cached state of a service if still fresh, each entry is used once
+	def restore(self, service, now):
+		entry = self.entries.pop(service, None)
+		if entry is None or now - self.timestamp > CACHE_MAX_AGE:
+			return None
+		return entry
+
+	# Writes the state of all sensors, unless nothing changed since a recent write
+	def save(self, statusList, now):
+		entries = []
+		for service, serviceStatus in sorted(statusList.items()):
+			name = service.encode('utf-8')
+			temperature = serviceStatus['temperature']
+			entries.append(self.ENTRY.pack(len(name), float('nan') if temperature is None else temperature))
+			entries.append(name)
+			entries.append(bytes(serviceStatus['conditions'].active))
+		entries = b''.join(entries)
+		if entries == self.saved and now - self.savedat < CACHE_MAX_AGE / 2:
+			return False
+		try:
+			tmp = self.path + '.tmp'
+			with open(tmp, 'wb') as f:
+				f.write(self.HEADER.pack(self.MAGIC, now, self.conditions))
+				f.write(entries)
+			os.replace(tmp, self.path)
+		except OSError as e:
+			logger.info('Error writing %s: %s', self.path, e)
+			return False
+		self.saved = entries
+		self.savedat = now
+		return True
+
+
+# Append-only binary trace of the temperature readings, condition transitions and relay
+# switches. Every run starts with a START record holding the wall clock time, the other
+# timestamps are monotonic. Services are numbered per run, a SERVICE record followed by
+# the name introduces each one.
+class TraceRecorder(object):
+	START = 0
+	SERVICE = 1
+	TEMPERATURE = 2  # Temperature in value, NaN when invalid
+	CONDITION = 3  # Condition in index, its new state in state
+	RELAY = 4  # Relay instance in id, its new state in state
+	RECORD = struct.Struct('<BdHBBd')  # Kind, timestamp, id, index, state, value
+	NAME = struct.Struct('<H')
+
+	def __init__(self, path, now):
+		self.file = open(path, 'ab')
+		self.ids = {}  # Service name -> id
+		self.temperatures = {}  # Service id -> last recorded temperature
+		self._write(self.START, now, value=time())
+
+	def _write(self, kind, now, id=0, index=0, state=0, value=0.0):
+		self.file.write(self.RECORD.pack(kind, now, id, index, state, value))
+
+	def _id(self, service, now):
+		id = self.ids.get(service)
+		if id is None:
+			id = self.ids[service] = len(self.ids)
+			name = service.encode('utf-8')
+			self._write(self.SERVICE, now, id)
+			self.file.write(self.NAME.pack(len(name)) + name)
+		return id
+
+	# Only readings that differ from the previous one are recorded
+	def temperature(self, now, service, temperature):
+		id = self._id(service, now)
+		if id in self.temperatures and self.temperatures[id] == temperature:
+			return
+		self.temperatures[id] = temperature
+		self._write(self.TEMPERATURE, now, id, value=float('nan') if temperature is None else temperature)
+
+	def condition(self, now, service, index, state):
+		self._write(self.CONDITION, now, self._id(service, now), index, state)
+
+	def relay(self, now, instance, state):
+		self._write(self.RELAY, now, instance, state=state)
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+	# Yields (kind, timestamp, service name or relay instance, index, state, value) for
+	# every record but the SERVICE ones
+	@classmethod
+	def read(cls, f):
+		names = {}
+		while True:
+			data = f.read(cls.RECORD.size)
+			if len(data) < cls.RECORD.size:
+				return
+			kind, now, id, index, state, value = cls.RECORD.unpack(data)
+			if kind == cls.START:
+				names = {}
+			elif kind == cls.SERVICE:
+				length, = cls.NAME.unpack(f.read(cls.NAME.size))
+				names[id] = f.read(length).decode('utf-8')
+				continue
+			elif kind in (cls.TEMPERATURE, cls.CONDITION):
+				id = names[id]
+			if kind == cls.TEMPERATURE and value != value:
+				value = None
+			yield kind, now, id, index, state, value
+
+
+# Minimum, maximum and mean temperature and the conditions that were active, per
+# interval, in preallocated ring buffers. A reading holds until the next one, the mean
+# is weighted by how long each reading held. Temperatures are in centidegrees, INVALID
+# when there was no valid reading. The states hold one bit per condition, for the first
+# eight conditions.
+class SensorHistory(object):
+	INVALID = -0x8000
+	HEADER = struct.Struct('<IHH')  # End of the last interval (unix time), interval, number of intervals
+
+	def __init__(self, length=HISTORY_LENGTH):
+		self.lows = array('h', [self.INVALID]) * length
+		self.highs = array('h', [self.INVALID]) * length
+		self.means = array('h', [self.INVALID]) * length
+		self.states = array('B', [0]) * length
+		self.head = 0  # Index of the next interval
+		self.count = 0
+		self.last = None  # Last reading
+		self.since = None  # Monotonic time of the last reading
+		self._reset()
+
+	def _reset(self):
+		self.low = self.high = self.last
+		self.total = 0
+		self.duration = 0
+		self.active = 0
+
+	def _mark(self, active):
+		if any(active):
+			for i, a in enumerate(active[:8]):
+				if a:
+					self.active |= 1 << i
+
+	def _advance(self, now):
+		if self.last is not None:
+			self.total += self.last * (now - self.since)
+			self.duration += now - self.since
+		self.since = now
+
+	def sample(self, now, temperature, active):
+		self._mark(active)
+		value = None if temperature is None else max(-0x7fff, min(0x7fff, centidegrees(temperature)))
+		# The same reading again only extends the time it held
+		if value == self.last:
+			return
+		self._advance(now)
+		self.last = value
+		if value is None:
+			return
+		if self.low is None or value < self.low:
+			self.low = value
+		if self.high is None or value > self.high:
+			self.high = value
+
+	# Ends the current interval
+	def close(self, now, active):
+		self._mark(active)
+		self._advance(now)
+		i = self.head
+		if self.low is None:
+			self.lows[i] = self.highs[i] = self.means[i] = self.INVALID
+		else:
+			self.lows[i] = self.low
+			self.highs[i] = self.high
+			self.means[i] = int(round(self.total / self.duration)) if self.duration > 0 else self.low
+		self.states[i] = self.active
+		self.head = (i + 1) % len(self.states)
+		self.count = min(self.count + 1, len(self.states))
+		self._reset()
+
+	# Header followed by the lows, highs, means (little endian int16) and states (uint8)
+	# of the intervals, oldest first
+	def pack(self, end, interval=HISTORY_INTERVAL):
+		parts = [self.HEADER.pack(int(end), interval, self.count)]
+		start = (self.head - self.count) % len(self.states)
+		for a in (self.lows, self.highs, self.means, self.states):
+			a = a[start:start + self.count] if start + self.count <= len(a) else a[start:] + a[:self.head]
+			if sys.byteorder == 'big':
+				a.byteswap()
+			parts.append(a.tobytes())
+		return b''.join(parts)
+
+	# Returns the end time, interval and a list of (low, high, mean, states) in degrees,
+	# None when invalid
+	@classmethod
+	def unpack(cls, blob):
+		end, interval, count = cls.HEADER.unpack_from(blob)
+		columns = []
+		offset = cls.HEADER.size
+		for typecode in 'hhhB':
+			a = array(typecode)
+			a.frombytes(blob[offset:offset + count * a.itemsize])
+			if sys.byteorder == 'big':
+				a.byteswap()
+			offset += count * a.itemsize
+			columns.append(a)
+		degrees = lambda v: None if v == cls.INVALID else v / 100.0
+		return end, interval, [(degrees(l), degrees(h), degrees(m), st) for l, h, m, st in zip(*columns)]
+
+
+# Exported on com.victronenergy.temprelay, so that the history of a sensor can be fetched
+# in one call instead of through thousands of paths
+class HistoryObject(dbus.service.Object):
+	def __init__(self, bus, relay):
+		dbus.service.Object.__init__(self, bus, '/History')
+		self._relay = relay
+
+	# Returns the history of the sensor with the given id as packed by SensorHistory.pack,
+	# empty for an unknown sensor
+	@dbus.service.method('com.victronenergy.TempSensorRelay', in_signature='s', out_signature='ay', byte_arrays=True)
+	def GetHistory(self, sensorId):
+		return dbus.ByteArray(self._relay._get_history(sensorId))
+
+
+class Relay(object):
+	__slots__ = ('instance', 'function', 'state', 'configured', 'pending', 'queued', 'sequence', 'attempts',
+		'on', 'changed', 'tokens', 'refilled', 'held', 'timer')
+
+	def __init__(self, instance):
+		self.instance = instance
+		self.function = ('com.victronenergy.settings', relay_function_path(instance))
+		self.state = ('com.victronenergy.system', relay_state_path(instance))
+		self.configured = False
+		self.pending = None  # State being written
+		self.queued = None  # State to write once the pending write is done
+		self.sequence = 0  # Identifies the last write, replies to older ones are ignored
+		self.attempts = 0
+		# Timing constraints
+		self.on = None  # Last state switched to, None until the first switch
+		self.changed = None  # Monotonic time of the last switch
+		self.tokens = None  # Starts left in the bucket of the start rate limit
+		self.refilled = None
+		self.held = False  # A switch is held back by the constraints
+		self.timer = False  # A timer re-checks the held switch
+
+	# The bucket holds at most 'starts' tokens and refills at 'starts' per hour
+	def refill(self, now, starts):
+		if self.tokens is None:
+			self.tokens = starts
+		else:
+			self.tokens = min(starts, self.tokens + (now - self.refilled) * starts / 3600.0)
+		self.refilled = now
+
+
 class DBusTempSensorRelay:
-	def __init__(self):
+	def __init__(self, conditions=2, batch=False, stats=False, dormant=False, cache=None, trace=None):
+		self.conditions = conditions
+		self._started = self._now()
+		self.startuptime = None  # Seconds from start to the first evaluation of the relays
+		self._batch = BatchEvaluator() if batch else None
+		self._stats = Stats(self._now()) if stats else None
+		self._cache = StateCache(cache, conditions) if cache else None
+		self._trace = TraceRecorder(trace, self._now()) if trace else None
+		self._batchlayoutchanged = True
 		self.relay_state_import = None
 		self.bus = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
 		self.dbusservice = None
+		self._historyobject = None
+		self._historyend = None  # Unix time the last history interval ended
 		self.evaluationpending = True
+		self.fullevaluationpending = True
+		self._ticks = 0
+		self.suppressedwrites = 0  # Writes to /Sensor/<id>/<n>/State skipped because nothing changed
+
+		# Relays found on the bus, indexed by instance, by their function setting and by their state
+		self._relaysList = {}
+		self._relayFunctions = {}
+		self._relayStates = {}
+
+		self._dbusmonitor = None
+		self._dormantmonitor = None
+		if dormant:
+			self._watch_relay_functions()
+		else:
+			self._start()
 
+	def _start(self):
+		# Only the paths used by the relay logic are monitored
 		dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
 		dbus_tree = {
-				'com.victronenergy.settings': { # Not our settings
-					'/Settings/Relay/Function': dummy,
-					'/Settings/Relay/1/Function': dummy
-				},
-				'com.victronenergy.system': {
-					'/Relay/0/State': dummy,
-					'/Relay/1/State': dummy
-				},
+				'com.victronenergy.settings': # Not our settings
+					{relay_function_path(i): dummy for i in RELAY_INSTANCES},
+				'com.victronenergy.system':
+					{relay_state_path(i): dummy for i in RELAY_INSTANCES},
 				'com.victronenergy.temperature': {
-					'/Connected': dummy,
 					'/DeviceInstance': dummy,
-					'/ProductName': dummy,
-					'/Temperature': dummy,
-					'/Mgmt/Connection': dummy
+					'/Temperature': dummy
 				},
 				'com.victronenergy.battery': {
-					'/Connected': dummy,
 					'/DeviceInstance': dummy,
-					'/ProductName': dummy,
 					'/Dc/0/Temperature': dummy,
-					'/System/MinCellTemperature': dummy,
-					'/Mgmt/Connection': dummy
+					'/System/MinCellTemperature': dummy
 				}
 			}
 
@@ -63,31 +750,115 @@ class DBusTempSensorRelay:
 				deviceAddedCallback=self._device_added, deviceRemovedCallback=self._device_removed)
 
 		self._statusList = {}
-		self._relaysList = {
-			'com.victronenergy.settings/Settings/Relay/Function': {
-				'state': 'com.victronenergy.system/Relay/0/State',
-				'configured': False
-			},
-			'com.victronenergy.settings/Settings/Relay/1/Function': {
-				'state': 'com.victronenergy.system/Relay/1/State',
-				'configured': False
-			}
-		}
+		self._virtual = {}  # Name -> VirtualSensor
+		self._virtualMembers = {}  # Sensor id -> names of the virtual sensors it is part of
+		# Identifiers, D-Bus paths and settings of each sensor, indexed by service name
+		self._sensors = {}
+		self._settingsIndex = {}  # Setting name -> (service name, D-Bus path)
+		self._pathsIndex = {}  # D-Bus path -> setting name
+		self._settingsLimits = {}  # Setting name -> (min, max)
+		self._pendingSettings = {}  # Setting name -> value not yet written to localsettings
+		self._discover_relays()
 
 		# Connect to localsettings
 		supportedSettings={
 				'mode': ['/Settings/TempSensorRelay/Mode', 0, 0, 100]  # Auto = 0, On = 1, Off = 2
 			}
+		for i in RELAY_INSTANCES:
+			# Minimum on and off times in seconds, maximum number of starts per hour (0 = no limit)
+			for name, maximum in (('MinOnTime', 86400), ('MinOffTime', 86400), ('MaxStartsPerHour', 3600)):
+				supportedSettings['{}_relay{}'.format(name, i)] = ['/Settings/TempSensorRelay/Relay/{}/{}'.format(i, name), 0, 0, maximum]
+		for n in range(VIRTUAL_SENSORS):
+			# None = 0, Min = 1, Max = 2, Mean = 3
+			supportedSettings['Function_virtual{}'.format(n)] = ['/Settings/TempSensorRelay/virtual{}/Function'.format(n), 0, 0, 3]
+			# Comma separated ids of the sensors, as used in /Sensor
+			supportedSettings['Members_virtual{}'.format(n)] = ['/Settings/TempSensorRelay/virtual{}/Members'.format(n), '', 0, 0]
+		for name, v in supportedSettings.items():
+			self._settingsLimits[name] = (v[2], v[3])
 		self.settings = self._create_settings(supportedSettings, self._handle_changed_setting)
-		GLib.timeout_add(1000, exit_on_error, self._handletimertick)
+		self._add_timer(1000, self._handletimertick)
+		if self._stats is not None:
+			self._add_timer(STATS_INTERVAL * 1000, self._publish_stats)
+		if self._cache is not None:
+			self._cache.load()
+			self._add_timer(CACHE_INTERVAL * 1000, self._save_cache)
+		if self._trace is not None:
+			self._add_timer(TRACE_FLUSH_INTERVAL * 1000, self._flush_trace)
+		self._add_timer(HISTORY_INTERVAL * 1000, self._close_history)
+		self._log_resources('Started')
+
+	# Dormant mode only watches the relay functions. The full monitor, the settings and
+	# the timers are created once a relay is set to the temperature function. The small
+	# monitor stays in place afterwards, the process does not go back to dormant mode.
+	def _watch_relay_functions(self):
+		dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
+		self._dormantmonitor = self._create_dbus_monitor(
+				{'com.victronenergy.settings': {relay_function_path(i): dummy for i in RELAY_INSTANCES}},
+				valueChangedCallback=self._dormant_value_changed, deviceAddedCallback=self._dormant_device_added)
+		self._log_resources('Dormant')
+		self._check_dormant()
+
+	def _check_dormant(self):
+		if self._dbusmonitor is not None:
+			return
+		for i in RELAY_INSTANCES:
+			if self._dormantmonitor.get_value('com.victronenergy.settings', relay_function_path(i)) == 4:
+				logger.info('Relay %s is set to the temperature function, leaving dormant mode', i)
+				self._start()
+				return
+
+	def _dormant_value_changed(self, dbusServiceName, dbusPath, options, changes, deviceInstance):
+		self._check_dormant()
+
+	def _dormant_device_added(self, dbusservicename, instance):
+		self._check_dormant()
+
+	def _log_resources(self, mode):
+		logger.info('%s after %.3f s, max RSS %d kB', mode, self._now() - self._started,
+			resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+	def _now(self):
+		return monotonic()
+
+	def _add_timer(self, timeout, callback, *args):
+		GLib.timeout_add(timeout, exit_on_error, callback, *args)
 
 	def _update_relays_config(self):
-		for i in self._relaysList:
-			self._relay_configuration_changed(i, self._check_relay_function(i))
+		for relay in list(self._relaysList.values()):
+			self._relay_configuration_changed(relay, self._check_relay_function(relay))
 
+	# Only the relays this service drove, the others belong to another function
 	def _release_relays(self):
-		for i in self._relaysList:
-			self._switchRelay(self._relaysList[i]['state'], 0)
+		for relay in self._relaysList.values():
+			if relay.configured:
+				self._switchRelay(relay, 0)
+
+	# A relay is usable once both its function setting and its state are on the bus
+	def _discover_relays(self):
+		for instance in RELAY_INSTANCES:
+			if instance in self._relaysList:
+				continue
+			relay = Relay(instance)
+			if self._dbusmonitor.get_value(*relay.function) is None or self._dbusmonitor.get_value(*relay.state) is None:
+				continue
+			logger.info('Found relay %s', instance)
+			self._relaysList[instance] = relay
+			self._relayFunctions[relay.function] = relay
+			self._relayStates[relay.state] = relay
+			if self.dbusservice is not None:
+				self._add_relay_paths(relay)
+			self.evaluationpending = True
+
+	# The timing constraints of a relay are published as /Relay/<instance>/...
+	def _add_relay_paths(self, relay):
+		with self.dbusservice as ctx:
+			for name in ('MinOnTime', 'MinOffTime', 'MaxStartsPerHour'):
+				setting = '{}_relay{}'.format(name, relay.instance)
+				path = '/Relay/{}/{}'.format(relay.instance, name)
+				self._settingsIndex[setting] = (None, path)
+				self._pathsIndex[path] = setting
+				ctx.add_path(path, self.settings[setting], writeable=True, onchangecallback=self._handleServiceValueChange)
+			ctx.add_path('/Relay/{}/Held'.format(relay.instance), int(relay.held))
 
 	def _create_settings(self, *args, **kwargs):
 		return SettingsDevice(self.bus, *args, timeout=10, **kwargs)
@@ -96,7 +867,8 @@ class DBusTempSensorRelay:
 		return DbusMonitor(*args, **kwargs)
 
 	def _create_dbus_service(self):
-		dbusservice = VeDbusService("com.victronenergy.temprelay", register=False)
+		# On the same connection as the history object
+		dbusservice = VeDbusService("com.victronenergy.temprelay", bus=self.bus, register=False)
 		dbusservice.add_mandatory_paths(
 			processname=__file__,
 			processversion=softwareVersion,
@@ -109,6 +881,9 @@ class DBusTempSensorRelay:
 			connected=1)
 		return dbusservice
 
+	def _create_history_object(self):
+		return HistoryObject(self.bus, self)
+
 	def _evaluate_if_we_are_needed(self):
 		if self._relays_configured():
 			if self.dbusservice is None:
@@ -117,15 +892,30 @@ class DBusTempSensorRelay:
 				self.dbusservice.add_path('/State', value=0)
 				self.dbusservice.add_path('/AvailableTemperatureServices', value=None)
 				self.dbusservice.add_path('/Sensor', value=None)
+				if self._stats is not None:
+					self._add_stats_paths()
+				for relay in self._relaysList.values():
+					self._add_relay_paths(relay)
 				self.dbusservice.register()
+				self._historyobject = self._create_history_object()
 				self._update_relays_config()
 				self._get_sensors()
 		else:
 			if self.dbusservice is not None:
 				self._release_relays()
+				if self._trace is not None:
+					self._trace.flush()
+				self._historyobject.remove_from_connection()
+				self._historyobject = None
 				self.dbusservice.__del__()
 				self.dbusservice = None
 				self._statusList = {}
+				self._virtual = {}
+				self._virtualMembers = {}
+				self._sensors = {}
+				self._settingsIndex = {}
+				self._pathsIndex = {}
+				self._batchlayoutchanged = True
 				self.relay_state_import = None
 				logger.info('No relay is set to temperature funtion: make sure the relay is released and going off dbus')
 		self.evaluationpending = False
@@ -139,12 +929,10 @@ class DBusTempSensorRelay:
 			return True
 
 		try:
-			for sensorId in self._statusList:
-				# Update temperatures
-				self._checkTemp(sensorId)
-				# Update conditions
-				self._checkValues(sensorId)
-			self._checkRelay()
+			start = perf_counter()
+			self._evaluate_tick()
+			if self._stats is not None:
+				self._stats.durations.append(perf_counter() - start)
 
 		except:
 			import traceback
@@ -152,27 +940,120 @@ class DBusTempSensorRelay:
 			sys.exit(1)
 		return True
 
+	def _evaluate_tick(self):
+		self._ticks += 1
+		full = self.fullevaluationpending or self._ticks % FULL_EVALUATION_TICKS == 0
+		self.fullevaluationpending = False
+		if full and self._batch is not None:
+			self._evaluate_all()
+			return
+		evaluated = False
+		for sensorId, serviceStatus in self._statusList.items():
+			# Valid temperatures are evaluated on change, the timer only keeps
+			# track of the sensors with invalid readings and feeds the filters
+			if (not full and serviceStatus['temperature'] is not None and serviceStatus['attempts'] == 0
+					and serviceStatus['filter'] is None):
+				continue
+			# Update temperatures
+			self._checkTemp(sensorId)
+			# Update conditions
+			self._checkValues(sensorId)
+			evaluated = True
+		if evaluated:
+			self._checkRelay()
+
+	def _add_stats_paths(self):
+		for path in ('/Debug/TickDuration/Mean', '/Debug/TickDuration/P99', '/Debug/TickDuration/Max',
+				'/Debug/EvaluationDuration/Mean', '/Debug/EvaluationDuration/P99', '/Debug/EvaluationDuration/Max',
+				'/Debug/EvaluationsPerSecond', '/Debug/SensorsRetrying'):
+			self.dbusservice.add_path(path, None)
+		self.dbusservice.add_path('/Debug/FailedRelayWrites', 0)
+		self.dbusservice.add_path('/Debug/SuppressedStateWrites', 0)
+		self.dbusservice.add_path('/Debug/StartupTime', self.startuptime)
+
+	def _publish_stats(self):
+		if self.dbusservice is None:
+			return True
+
+		stats = self._stats
+		now = self._now()
+		with self.dbusservice as ctx:
+			self._publish_durations(ctx, '/Debug/TickDuration', stats.durations)
+			self._publish_durations(ctx, '/Debug/EvaluationDuration', stats.eventdurations)
+			if now > stats.since:
+				ctx['/Debug/EvaluationsPerSecond'] = round(stats.evaluations / (now - stats.since), 1)
+			stats.evaluations = 0
+			stats.since = now
+			ctx['/Debug/SensorsRetrying'] = sum(1 for s in self._statusList.values() if s['attempts'] > 0)
+			ctx['/Debug/FailedRelayWrites'] = stats.failedwrites
+			ctx['/Debug/SuppressedStateWrites'] = self.suppressedwrites
+			for instance, count in stats.switches.items():
+				path = '/Debug/Relay/{}/Switches'.format(instance)
+				if path in ctx:
+					ctx[path] = count
+				else:
+					ctx.add_path(path, count)
+		return True
+
+	# Durations in milliseconds
+	def _publish_durations(self, ctx, prefix, durations):
+		if not durations:
+			return
+		durations = sorted(durations)
+		ctx[prefix + '/Mean'] = round(1000 * sum(durations) / len(durations), 3)
+		ctx[prefix + '/P99'] = round(1000 * durations[int(0.99 * (len(durations) - 1))], 3)
+		ctx[prefix + '/Max'] = round(1000 * durations[-1], 3)
+
+	def _report_startup(self):
+		self.startuptime = round(self._now() - self._started, 3)
+		logger.info('First evaluation %.3f s after start, %d sensors', self.startuptime, len(self._statusList))
+		if self._stats is not None and self.dbusservice is not None:
+			self.dbusservice['/Debug/StartupTime'] = self.startuptime
+
+	def _flush_trace(self):
+		if self._trace is not None:
+			self._trace.flush()
+		return True
+
+	# Writes out what is still buffered, called on exit
+	def close(self):
+		if self._trace is not None:
+			self._trace.close()
+			self._trace = None
+
+	def _close_history(self):
+		if self.dbusservice is not None:
+			now = self._now()
+			for serviceStatus in self._statusList.values():
+				serviceStatus['history'].close(now, serviceStatus['conditions'].active)
+			self._historyend = time()
+		return True
+
+	def _get_history(self, sensorId):
+		for service, sensor in self._sensors.items():
+			if sensor['id'] == sensorId and service in self._statusList:
+				return self._statusList[service]['history'].pack(self._historyend or time())
+		return b''
+
+	def _save_cache(self):
+		if self.dbusservice is not None:
+			self._cache.save(self._statusList, self._now())
+		return True
+
 	def _path_to_setting(self, path):
-		p = path.replace('/Sensor/', '')
-		if len(p.split('/')) > 2:
-			s = 'c{1}{2}_{0}'.format(*p.split('/'))
-		else:
-			s = '{1}_{0}'.format(*p.split('/'))
-		return s
+		return self._pathsIndex[path]
 
 	def _setting_to_path(self, setting):
-		c = re.match(r'^c[0-9]+', setting).group(0).replace('c', '')
-		a = [setting.split('_', 1)[1], c, re.sub(r'^c[0-9]+','', setting).split('_')[0]]
-		return '{0}/{1}/{2}'.format(*a)
+		return self._settingsIndex[setting][1]
 
 	def _handle_changed_setting(self, setting, oldvalue, newvalue):
 
-		if re.match(r'^c[0-9]+', setting):
-			self.dbusservice['/Sensor/' + self._setting_to_path(setting)] = newvalue
+		if setting in self._settingsIndex:
+			self.dbusservice[self._setting_to_path(setting)] = newvalue
 
-		if 'c0Relay' in setting or 'c1Relay' in setting:
+		if setting.startswith('c') and 'Relay_' in setting:
 			sensor = setting.split("_", 1)[1]
-			condition = setting[1]
+			condition = setting[1:setting.index('Relay_')]
 			logger.info('Sensor %s condition %s is now driving relay %s', sensor, condition, newvalue )
 
 		if 'enable_' in setting:
@@ -181,131 +1062,333 @@ class DBusTempSensorRelay:
 			if newvalue == 1:
 				self._add_sensor_to_service(service)
 
+		if setting.startswith(('Function_virtual', 'Members_virtual')) and self.dbusservice is not None:
+			self._update_virtual_sensor(setting.split('_', 1)[1])
+
+		if setting in self._settingsIndex:
+			service = self._settingsIndex[setting][0]
+			if service in self._statusList:
+				self._update_conditions(service)
+				self._evaluate_sensor(service, settingschanged=True)
+
 	def _check_relay_function(self, relay):
-		return self._dbusmonitor.get_value(relay.split('/')[0], '/' + relay.split('/', 1)[1]) == 4
+		return self._dbusmonitor.get_value(*relay.function) == 4
 
 	def _relay_configuration_changed(self, relay, enabled):
 		if not enabled:
-			if (self._relaysList[relay]['configured']):
-				self._switchRelay(self._relaysList[relay]['state'], 0)
-			self._relaysList[relay]['configured'] = False
+			if relay.configured:
+				self._switchRelay(relay, 0)
+			relay.configured = False
 		else:
-			self._relaysList[relay]['configured'] = True
+			relay.configured = True
+		self.fullevaluationpending = True
 		self._evaluate_if_we_are_needed()
 
 	def _relays_configured(self):
-		for i in self._relaysList:
-			if self._check_relay_function(i):
+		for relay in self._relaysList.values():
+			if self._check_relay_function(relay):
 				return True
 
-	def _get_relay_config_path(self, instance):
-		# "Instaces" elay 0 and 1 refer to the built-in relays
-		service = ""
-		if instance == 0:
-			service = "com.victronenergy.settings/Settings/Relay/Function"
-		elif instance == 1:
-			service = "com.victronenergy.settings/Settings/Relay/1/Function"
-		return service
-
 	# Find temperature sensor services
 	def _get_sensors(self):
+		services = [service for service in self._dbusmonitor.get_service_list()
+				if 'com.victronenergy.temperature' in service or self._isBatteryServiceWithTemp(service)]
+		self._addTempServices(services)
+		for n in range(VIRTUAL_SENSORS):
+			self._update_virtual_sensor('virtual{}'.format(n))
+
+	# Virtual sensors are published in /Sensor like the others, with their name as id
+	def _update_virtual_sensor(self, name):
+		old = self._virtual.pop(name, None)
+		if old is not None:
+			for member in old.members:
+				self._virtualMembers[member].remove(name)
+				if not self._virtualMembers[member]:
+					del self._virtualMembers[member]
+
+		function = self.settings['Function_' + name]
+		members = set(m.strip() for m in self.settings['Members_' + name].split(',') if m.strip())
+		if function == VirtualSensor.NONE or not members:
+			if name in self._statusList:
+				self._remove_sensor(name)
+			return
+
+		virtual = self._virtual[name] = VirtualSensor(function, members)
+		for member in members:
+			self._virtualMembers.setdefault(member, []).append(name)
 		for service in self._dbusmonitor.get_service_list():
-			if 'com.victronenergy.temperature' in service or self._isBatteryServiceWithTemp(service):
-				self._addTempService(service)
+			if self._getSensorId(service) in members:
+				virtual.update(service, self._get_temperature(service))
+		logger.info('Virtual sensor %s over %s', name, ', '.join(sorted(members)))
+
+		if name in self._statusList:
+			self._evaluate_sensor(name)
+		else:
+			self._addTempService(name)
+
+	# A new reading of a member of virtual sensors
+	def _update_virtual_members(self, service):
+		names = self._virtualMembers.get(self._getSensorId(service))
+		if names is None:
+			return
+		temperature = self._get_temperature(service)
+		for name in names:
+			self._virtual[name].update(service, temperature)
+			if name in self._statusList:
+				self._evaluate_sensor(name)
 
 	def _addTempService(self, serviceName):
+		self._addTempServices([serviceName])
+
+	# The settings of all sensors are registered with localsettings in a single call
+	def _addTempServices(self, serviceNames):
+		sensorSettings = [(serviceName, self._sensor_settings(serviceName)) for serviceName in serviceNames]
+		settings = {}
+		for serviceName, s in sensorSettings:
+			settings.update(s)
+		if not settings:
+			return
+		self.settings.addSettings(settings)
+
+		for serviceName, settings in sensorSettings:
+			self._register_sensor(serviceName, settings)
+			if serviceName not in self._statusList:
+				self._statusList[serviceName] = {
+					'enabled': False,
+					'attempts': 0,
+					'temperature': None,
+					'conditions': ConditionTable(self.conditions),
+					'filter': None,
+					'raw': None,  # Last reading before the filter
+					'trend': None,
+					'history': SensorHistory()
+				}
+				self._update_conditions(serviceName)
+				self._restore_state(serviceName)
+				self._add_sensor_to_service(serviceName)
+				self._batchlayoutchanged = True
+
+	# Resume with the state saved before a restart, so that active conditions stay active
+	def _restore_state(self, serviceName):
+		if self._cache is None:
+			return
+		cached = self._cache.restore(serviceName, self._now())
+		if cached is None:
+			return
+		serviceStatus = self._statusList[serviceName]
+		serviceStatus['temperature'], active = cached
+		conditions = serviceStatus['conditions']
+		for i in range(len(conditions)):
+			conditions.active[i] = active[i]
+		logger.info('Restored the state of %s', serviceName)
+
+	def _sensor_settings(self, serviceName):
 		settings = {}
 		deviceSettingsBase = {
 			'Enabled_{0}': ['/Settings/TempSensorRelay/{0}/Enabled', 0, 0, 2],  # Disabled = 0, Enabled = 1
-			'c0Relay_{0}': ['/Settings/TempSensorRelay/{0}/0/Relay', -1, -1, 100],
-			'c0SetValue_{0}': ['/Settings/TempSensorRelay/{0}/0/SetValue', 0, -100, 100],  
-			'c0ClearValue_{0}': ['/Settings/TempSensorRelay/{0}/0/ClearValue', 0, -100, 100],
-			'c1Relay_{0}': ['/Settings/TempSensorRelay/{0}/1/Relay', -1, -1, 100],
-			'c1SetValue_{0}': ['/Settings/TempSensorRelay/{0}/1/SetValue', 0, -100, 100],  
-			'c1ClearValue_{0}': ['/Settings/TempSensorRelay/{0}/1/ClearValue', 0, -100, 100]
+			'Filter_{0}': ['/Settings/TempSensorRelay/{0}/Filter', 0, 0, 3],  # None = 0, EMA = 1, Median = 2, Dwell = 3
+			'FilterWindow_{0}': ['/Settings/TempSensorRelay/{0}/FilterWindow', 10, 1, 600],  # Seconds, or readings of the median (at most 15)
+			'LeadTime_{0}': ['/Settings/TempSensorRelay/{0}/LeadTime', 0, 0, 3600]  # Seconds, 0 = no prediction
 		}
+		conditionSettingsBase = {
+			'c{1}Relay_{0}': ['/Settings/TempSensorRelay/{0}/{1}/Relay', -1, -1, 100],
+			'c{1}SetValue_{0}': ['/Settings/TempSensorRelay/{0}/{1}/SetValue', 0.0, -100.0, 100.0],
+			'c{1}ClearValue_{0}': ['/Settings/TempSensorRelay/{0}/{1}/ClearValue', 0.0, -100.0, 100.0]
+		}
+		for i in range(self.conditions):
+			for s in conditionSettingsBase:
+				v = conditionSettingsBase[s][:]  # Copy
+				v[0] = v[0].format('{0}', i)
+				deviceSettingsBase[s.format('{0}', i)] = v
 		sensorId = self._getSensorId(serviceName)
 		for s in deviceSettingsBase:
 			v = deviceSettingsBase[s][:]  # Copy
 			v[0] = v[0].format(sensorId)
 			settings[s.format(sensorId)] = v
-		self.settings.addSettings(settings)
+		return settings
 
-		if serviceName not in self._statusList:
-			self._statusList[serviceName] = {
-				'enabled': False,
-				'c0Active': False,
-				'c1Active': False,
-				'attempts': 0,
-				'temperature': None,
-				'c0Relay': '',
-				'c1Relay': ''
-			}
-			self._add_sensor_to_service(serviceName)
+	def _register_sensor(self, serviceName, settings):
+		sensorId = self._getSensorId(serviceName)
+		prefix = '/Sensor/' + sensorId
+		settingsprefix = '/Settings/TempSensorRelay/' + sensorId
+		paths = {}
+		# /Settings/TempSensorRelay/<id>/... is published as /Sensor/<id>/...
+		for name, v in settings.items():
+			path = prefix + v[0][len(settingsprefix):]
+			paths[path] = name
+			self._settingsIndex[name] = (serviceName, path)
+			self._pathsIndex[path] = name
+			self._settingsLimits[name] = (v[2], v[3])
+		self._sensors[serviceName] = {
+			'id': sensorId,
+			'prefix': prefix,
+			'paths': paths,
+			'statepaths': [prefix + '/{}/State'.format(i) for i in range(self.conditions)]
+		}
+
+	def _unregister_sensor(self, serviceName):
+		sensor = self._sensors.pop(serviceName, None)
+		if sensor is None:
+			return
+		for path, name in sensor['paths'].items():
+			del self._settingsIndex[name]
+			del self._pathsIndex[path]
+			del self._settingsLimits[name]
+
+	# Read the settings of a sensor once, so that evaluating it does not need any lookups
+	def _update_conditions(self, service):
+		serviceStatus = self._statusList[service]
+		serviceStatus['enabled'] = self._getSetting('Enabled', service)
+		mode = self._getSetting('Filter', service)
+		window = self._getSetting('FilterWindow', service)
+		filt = serviceStatus['filter']
+		if mode == TemperatureFilter.NONE:
+			serviceStatus['filter'] = None
+		elif filt is None or filt.mode != mode or filt.window != window:
+			serviceStatus['filter'] = TemperatureFilter(mode, window, self.conditions)
+		lead = self._getSetting('LeadTime', service)
+		if lead == 0:
+			serviceStatus['trend'] = None
+		elif serviceStatus['trend'] is None:
+			serviceStatus['trend'] = TemperatureTrend(lead)
+		else:
+			serviceStatus['trend'].lead = lead
+		conditions = serviceStatus['conditions']
+		for i in range(len(conditions)):
+			c = 'c' + str(i)
+			conditions.relays[i] = self._getSetting(c + 'Relay', service)
+			conditions.setvalues[i] = centidegrees(self._getSetting(c + 'SetValue', service))
+			conditions.clearvalues[i] = centidegrees(self._getSetting(c + 'ClearValue', service))
 
 	def _add_sensor_to_service(self, sensor):
 		settings = ['SetValue', 'ClearValue', 'Relay']
-		sensorprefix = '/Sensor/' + self._getSensorId(sensor)
+		sensorprefix = self._sensors[sensor]['prefix']
 		if self.dbusservice != None and (sensorprefix + "/Enabled") not in self.dbusservice:
-			enabledval = self.settings[self._path_to_setting(sensorprefix + '/Enabled')]
-			self.dbusservice.add_path(sensorprefix + '/Enabled', None, writeable=True, onchangecallback=self._handleServiceValueChange)
-			self.dbusservice[sensorprefix + '/Enabled'] = enabledval
-			self.dbusservice.add_path(sensorprefix + '/ServiceName', None)
-			self.dbusservice[sensorprefix + '/ServiceName'] = sensor
-			self.dbusservice.add_path(sensorprefix + '/ServiceInstance', None)
-			self.dbusservice[sensorprefix + '/ServiceInstance'] = self._getServiceInstance(sensor)
-
-			for i in range(0, 2):
-				p = sensorprefix + '/'  + str(i) + '/'
-				self.dbusservice.add_path(p + 'State', 0)
-				for k in settings:
-					val = self.settings[self._path_to_setting(p + k)]
-					self.dbusservice.add_path(p + k, None, writeable=True, onchangecallback=self._handleServiceValueChange)
-					self.dbusservice[p + k] = val
-
+			# Publish the whole subtree of the sensor as a single ItemsChanged signal
+			with self.dbusservice as ctx:
+				enabledval = self.settings[self._path_to_setting(sensorprefix + '/Enabled')]
+				ctx.add_path(sensorprefix + '/Enabled', enabledval, writeable=True, onchangecallback=self._handleServiceValueChange)
+				ctx.add_path(sensorprefix + '/ServiceName', sensor)
+				ctx.add_path(sensorprefix + '/ServiceInstance', self._getServiceInstance(sensor))
+				for k in ('Filter', 'FilterWindow', 'LeadTime'):
+					val = self.settings[self._path_to_setting(sensorprefix + '/' + k)]
+					ctx.add_path(sensorprefix + '/' + k, val, writeable=True, onchangecallback=self._handleServiceValueChange)
+
+				for i in range(self.conditions):
+					p = sensorprefix + '/'  + str(i) + '/'
+					ctx.add_path(p + 'State', 0)
+					for k in settings:
+						val = self.settings[self._path_to_setting(p + k)]
+						ctx.add_path(p + k, val, writeable=True, onchangecallback=self._handleServiceValueChange)
 
 	def _handleServiceValueChange(self, path, newvalue):
-		if '/Sensor/' not in path:
+		if not path.startswith(('/Sensor/', '/Relay/')):
 			return True
-		self.settings[self._path_to_setting(path)] = int(newvalue)
+		setting = self._path_to_setting(path)
+		# Set and clear values have two decimals, everything else is an integer
+		try:
+			value = round(float(newvalue), 2) if path.endswith('Value') else int(newvalue)
+		except (TypeError, ValueError):
+			return False
+		# The value is used before localsettings sees it, so it is checked here
+		minimum, maximum = self._settingsLimits[setting]
+		if not minimum <= value <= maximum:
+			return False
+		if not self._pendingSettings:
+			self._add_timer(SETTINGS_FLUSH_DELAY, self._flush_settings)
+		self._pendingSettings[setting] = value
+
+		# Act on the new value right away, it is written to localsettings later
+		service = self._settingsIndex[setting][0]
+		if service is None:
+			# Timing constraint of a relay, a held switch may be allowed now
+			self.fullevaluationpending = True
+		elif service in self._statusList:
+			self._update_conditions(service)
+			self._evaluate_sensor(service, settingschanged=True)
 		return True
 
+	def _flush_settings(self):
+		# The buffer stays in place while writing, so the change callbacks of
+		# the first writes do not see the old values of the later ones
+		for setting, value in self._pendingSettings.items():
+			if self.settings[setting] != value:
+				self.settings[setting] = value
+		self._pendingSettings = {}
+		return False
+
 	def _dbus_value_changed(self, dbusServiceName, dbusPath, options, changes, deviceInstance):
 		if dbusServiceName == 'com.victronenergy.settings':
-			if dbusServiceName + dbusPath in self._relaysList and changes != None:
+			if (dbusServiceName, dbusPath) not in self._relayFunctions:
+				self._discover_relays()
+			relay = self._relayFunctions.get((dbusServiceName, dbusPath))
+			if relay is not None and changes != None:
 				value =  int(changes['Value']) if not isinstance(changes, int) else changes
-				logger.info('Function changed for relay %s: %s', dbusServiceName + dbusPath, value)
-				self._relay_configuration_changed(dbusServiceName + dbusPath, value == 4) # Function 4 -> Temp sensor
+				logger.info('Function changed for relay %s: %s', relay.instance, value)
+				self._relay_configuration_changed(relay, value == 4) # Function 4 -> Temp sensor
 				self.evaluationpending = True
+		elif dbusServiceName == 'com.victronenergy.system':
+			# The state of a relay can show up after its function setting, on a system
+			# service that is already running
+			if (dbusServiceName, dbusPath) not in self._relayStates:
+				self._discover_relays()
+				relay = self._relayStates.get((dbusServiceName, dbusPath))
+				if relay is not None:
+					self._relay_configuration_changed(relay, self._check_relay_function(relay))
+		elif dbusPath in TEMPERATURE_PATHS:
+			if dbusServiceName in self._statusList:
+				self._evaluate_sensor(dbusServiceName)
+			elif self.dbusservice is not None and self._isBatteryServiceWithTemp(dbusServiceName):
+				# Batteries are only picked up once they publish a temperature
+				logger.info('Battery %s now has a temperature, adding it', dbusServiceName)
+				self._addTempService(dbusServiceName)
+			if self._virtualMembers:
+				self._update_virtual_members(dbusServiceName)
 		return
 
 	def _device_removed(self, dbusservicename, instance):
-		if 'com.victronenergy.temperature' in dbusservicename:
-			if dbusservicename in self._statusList:
-				logger.info('Service %s is no longer available, removing it...', dbusservicename)
-				del self._statusList[dbusservicename]
-				self._remove_sensor_form_dbus_service(dbusservicename)
+		if dbusservicename in self._statusList:
+			logger.info('Service %s is no longer available, removing it...', dbusservicename)
+			self._remove_sensor(dbusservicename)
+		if self._virtualMembers:
+			self._update_virtual_members(dbusservicename)
+
+	def _remove_sensor(self, service):
+		del self._statusList[service]
+		self._remove_sensor_form_dbus_service(service)
+		self._unregister_sensor(service)
+		self._batchlayoutchanged = True
 
 	def _device_added(self, dbusservicename, instance):
 		logger.info('Device added: %s', dbusservicename)
+		if dbusservicename in ('com.victronenergy.settings', 'com.victronenergy.system'):
+			self._discover_relays()
 		if self.dbusservice == None:
 			return
 		if 'com.victronenergy.temperature' in dbusservicename or self._isBatteryServiceWithTemp(dbusservicename):
 			self._evaluate_if_we_are_needed()
 			self._addTempService(dbusservicename)
+		if self._virtualMembers:
+			self._update_virtual_members(dbusservicename)
 
 	def _remove_sensor_form_dbus_service(self, sensor):
 		items = ['SetValue', 'ClearValue', 'Relay', 'State']
-		sp = '/Sensor/' + self._getSensorId(sensor)
-		self.dbusservice.__delitem__(sp + '/ServiceName')
-		self.dbusservice.__delitem__(sp + '/ServiceInstance')
-		self.dbusservice.__delitem__(sp + '/Enabled')
-		for i in range(0, 2):
-			p = sp + '/'  + str(i) + '/'
-			for k in items:
-				self.dbusservice.__delitem__(p + k)
+		sp = self._sensors[sensor]['prefix']
+		with self.dbusservice as ctx:
+			del ctx[sp + '/ServiceName']
+			del ctx[sp + '/ServiceInstance']
+			del ctx[sp + '/Enabled']
+			del ctx[sp + '/Filter']
+			del ctx[sp + '/FilterWindow']
+			del ctx[sp + '/LeadTime']
+			for i in range(self.conditions):
+				p = sp + '/'  + str(i) + '/'
+				for k in items:
+					del ctx[p + k]
 
 	def _get_temperature(self, service):
+		if service in self._virtual:
+			return self._virtual[service].value()
 		if 'com.victronenergy.temperature' in service:
 			return self._dbusmonitor.get_value(service, "/Temperature")
 		elif 'com.victronenergy.battery' in service:
@@ -315,8 +1398,44 @@ class DBusTempSensorRelay:
 				return self._dbusmonitor.get_value(service, "/Dc/0/Temperature")
 		return None
 
-	def _checkTemp(self, service):
+	# The relays only need to be updated when a condition of the sensor changed state,
+	# or when its settings changed
+	def _evaluate_sensor(self, service, settingschanged=False):
+		start = perf_counter() if self._stats is not None else None
+		serviceStatus = self._statusList[service]
+		serviceStatus['temperature'] = self._read_temperature(service)
+		active = bytes(serviceStatus['conditions'].active)
+		# Invalid readings are left to the timer, which keeps count of the retries
+		if serviceStatus['temperature'] is not None:
+			self._checkValues(service)
+		if settingschanged or bytes(serviceStatus['conditions'].active) != active:
+			self._checkRelay()
+		if start is not None:
+			self._stats.eventdurations.append(perf_counter() - start)
+
+	# Current temperature of the sensor, passed through its filter
+	def _read_temperature(self, service):
 		temperature = self._get_temperature(service)
+		# Virtual sensors follow from the readings of their members
+		if self._trace is not None and service not in self._virtual:
+			self._trace.temperature(self._now(), service, temperature)
+		serviceStatus = self._statusList[service]
+		now = self._now()
+		# Values are only signalled on change, the same value again is the same reading
+		new = temperature != serviceStatus['raw']
+		serviceStatus['raw'] = temperature
+		filt = serviceStatus['filter']
+		if filt is not None:
+			temperature = filt.update(temperature, now, new)
+		trend = serviceStatus['trend']
+		# A trend set up since the last change starts from the held reading
+		if trend is not None and (new or not trend.samples):
+			trend.update(now, temperature)
+		serviceStatus['history'].sample(now, temperature, serviceStatus['conditions'].active)
+		return temperature
+
+	def _checkTemp(self, service):
+		temperature = self._read_temperature(service)
 
 		self._statusList[service]['temperature'] = temperature
 		# In case of invalid temperature values keep track or retries
@@ -324,66 +1443,107 @@ class DBusTempSensorRelay:
 			self._statusList[service]['attempts'] += 1
 
 	def _getSetting(self, setting, service):
-		srvc = self._getSensorId(service)
-		service = self._getSensorId(srvc)
-		return self.settings[setting + "_" + srvc]
+		setting = setting + "_" + self._getSensorId(service)
+		if setting in self._pendingSettings:
+			return self._pendingSettings[setting]
+		return self.settings[setting]
+
+	def _getRelaySetting(self, setting, relay):
+		setting = '{}_relay{}'.format(setting, relay.instance)
+		if setting in self._pendingSettings:
+			return self._pendingSettings[setting]
+		return self.settings[setting]
+
+	# Evaluate all sensors at once with the batch evaluator
+	def _evaluate_all(self):
+		batch = self._batch
+		if self._batchlayoutchanged:
+			batch.attach([(service, serviceStatus['conditions']) for service, serviceStatus in self._statusList.items()])
+			self._batchlayoutchanged = False
+		if self._stats is not None:
+			self._stats.evaluations += len(batch.services)
+		for i, service in enumerate(batch.services):
+			self._checkTemp(service)
+			serviceStatus = self._statusList[service]
+			temperature = serviceStatus['temperature']
+			batch.temperatures[i] = float('nan') if temperature is None else reading_centidegrees(temperature)
+			evaluate = self._canEvaluate(service)
+			# Dwell times are kept per condition and the batch does not predict, those
+			# sensors are evaluated one by one
+			if evaluate and ((serviceStatus['filter'] is not None and serviceStatus['filter'].since is not None)
+					or serviceStatus['trend'] is not None):
+				self._evaluate_conditions(service)
+				evaluate = False
+			batch.evaluate[i] = evaluate
+		relays = self._relaysList
+		self._checkRelay(batch.update([i in relays and relays[i].configured for i in RELAY_INSTANCES]))
 
 	def _checkValues(self, service):
-		sensorId = self._getSensorId(service)
-		c0Relay = self._get_relay_config_path(self._getSetting('c0Relay', service))
-		c1Relay = self._get_relay_config_path(self._getSetting('c1Relay', service))
-		mode = self._getSetting('Enabled', service)
-		temperature = self._statusList[service]['temperature']
+		if self._stats is not None:
+			self._stats.evaluations += 1
+		if self._canEvaluate(service):
+			self._evaluate_conditions(service)
+
+	# Handles disabled sensors and invalid readings, returns whether the conditions
+	# of the sensor must be evaluated
+	def _canEvaluate(self, service):
 		serviceStatus = self._statusList[service]
-		evaluate = True
+		conditions = serviceStatus['conditions']
+		temperature = serviceStatus['temperature']
 		attempts = serviceStatus['attempts']
 
-		# Update which relay belongs to each condition
-		if serviceStatus['c0Relay'] != c0Relay:
-			serviceStatus['c0Relay'] = str(c0Relay)
-
-		if serviceStatus['c1Relay'] != c1Relay:
-			serviceStatus['c1Relay'] = str(c1Relay)
-
-		if mode == 0:
-			if serviceStatus['c0Active'] or serviceStatus['c1Active']:
+		if serviceStatus['enabled'] == 0:
+			if any(conditions.active):
 				logger.info('Relay driving for service %s has been disabled, releasing relays', service)
-			serviceStatus['c0Active'] = 0
-			serviceStatus['c1Active'] = 0
-			return
+			conditions.release()
+			return False
 
-		if attempts > 0 and attempts < READ_RETRIES:
-			if temperature is not None:
-				serviceStatus['attempts'] = 0
-				logger.info('Value of %s temperature is valid again, resuming evaluation', service)
-			if attempts > 0 and attempts < READ_RETRIES and attempts % 10 == 0:
-				logger.info('Error reading %s temperature, retriying... [%s / %s]',
-				service, attempts, READ_RETRIES)
-			# Nothing to do, return and wait till the next read
-			return
-		elif attempts > 0 and attempts == READ_RETRIES:
+		if attempts > 0 and attempts <= READ_RETRIES:
 			if temperature is not None:
 				serviceStatus['attempts'] = 0
 				logger.info('Value of %s temperature is valid again, resuming evaluation', service)
+			elif attempts < READ_RETRIES:
+				if attempts % 10 == 0:
+					logger.info('Error reading %s temperature, retriying... [%s / %s]',
+					service, attempts, READ_RETRIES)
+				# Nothing to do, return and wait till the next read
+				return False
 			else:
 				logger.info('Error reading %s temperature after %s attepmts. Disabling relay driving for this condition.',
 				service, attempts)
-				serviceStatus['c0Active'] = 0
-				serviceStatus['c1Active'] = 0
-				return
-
-		if c0Relay and c0Relay != "-1" and evaluate:
-			c0Set = self._getSetting('c0SetValue', service)
-			c0Clear = self._getSetting('c0ClearValue', service)
-			inRange = self._inRange(c0Set, c0Clear, temperature, serviceStatus['c0Active'])
-			serviceStatus['c0Active'] =  inRange and self._relaysList[c0Relay]['configured']
-
-		if c1Relay and c1Relay != "-1" and evaluate:
-			c1Set = self._getSetting('c1SetValue', service)
-			c1Clear = self._getSetting('c1ClearValue', service)
-			inRange = self._inRange(c1Set, c1Clear, temperature, serviceStatus['c1Active'])
-			serviceStatus['c1Active'] =  inRange and self._relaysList[c1Relay]['configured']
+				conditions.release()
+				return False
+		return True
 
+	def _evaluate_conditions(self, service):
+		serviceStatus = self._statusList[service]
+		conditions = serviceStatus['conditions']
+		temperature = serviceStatus['temperature']
+		if temperature is not None:
+			temperature = reading_centidegrees(temperature)
+		active = conditions.active
+		setvalues = conditions.setvalues
+		clearvalues = conditions.clearvalues
+		filt = serviceStatus['filter']
+		now = self._now() if filt is not None else None
+		# A condition also holds when the trend crosses its set value within the lead time
+		projected = None
+		if serviceStatus['trend'] is not None and temperature is not None:
+			projected = serviceStatus['trend'].projected()
+			if projected is not None:
+				projected = reading_centidegrees(projected)
+		for i, r in enumerate(conditions.relays):
+			if r >= 0:
+				relay = self._relaysList.get(r)
+				inRange = self._inRange(setvalues[i], clearvalues[i], temperature, active[i])
+				if not inRange and projected is not None:
+					inRange = self._inRange(setvalues[i], clearvalues[i], projected, False)
+				state = inRange and relay is not None and relay.configured
+				if filt is not None and not filt.settled(i, state != bool(active[i]), now):
+					continue
+				active[i] = state
+
+	# All values in centidegrees
 	def _inRange(self, setVal, clearVal, val, active):
 		if val == None:
 			return False
@@ -394,9 +1554,11 @@ class DBusTempSensorRelay:
 			return val <= setVal or (active and val < clearVal)
 
 	def _isBatteryServiceWithTemp(self, service):
-		return 'com.victronenergy.battery' in service and self._dbusmonitor.get_value(service, "/Dc/0/Temperature") is not None
+		return 'com.victronenergy.battery' in service and self._get_temperature(service) is not None
 
 	def _getSensorId(self, service):
+		if service in self._sensors:
+			return self._sensors[service]['id']
 		if 'com.victronenergy.temperature.' in service:
 			return service.split('com.victronenergy.temperature.')[1]
 		elif 'com.victronenergy.battery' in service:
@@ -406,47 +1568,164 @@ class DBusTempSensorRelay:
 	def _getServiceInstance(self, service):
 		return self._dbusmonitor.get_value(service, "/DeviceInstance")
 
-	def _checkRelay(self):
-		relays = {}
-
-		for k in self._relaysList:
-			relays[k] = False
+	# states, when given, holds the relay states already determined by the batch evaluator
+	def _checkRelay(self, states=None):
+		if self.startuptime is None:
+			self._report_startup()
+		relays = dict.fromkeys(self._relaysList, False)
 
 		# Determine the what the relays status should be based on active conditions
-		for service in self._statusList:
-			c0Relay = self._statusList[service]['c0Relay']
-			c0Active = self._statusList[service]['c0Active']
-			c1Relay = self._statusList[service]['c1Relay']
-			c1Active = self._statusList[service]['c1Active']
-
-			if (c0Relay):
-				relays[c0Relay] |= c0Active
-
-			if (c1Relay):
-				relays[c1Relay] |= c1Active
+		for service, serviceStatus in self._statusList.items():
+			conditions = serviceStatus['conditions']
+			if states is None:
+				for r, active in zip(conditions.relays, conditions.active):
+					if active and r in relays:
+						relays[r] = True
 
-			sensorspath = '/Sensor/' + self._getSensorId(service)
 			# Set the condition status in the service
-			if self.dbusservice and sensorspath:
-				self.dbusservice[sensorspath + "/0/State"] = c0Active
-				self.dbusservice[sensorspath + "/1/State"] = c1Active
+			if self.dbusservice:
+				for i, (path, active) in enumerate(zip(self._sensors[service]['statepaths'], conditions.active)):
+					if self._publish_state(path, int(active)) and self._trace is not None:
+						self._trace.condition(self._now(), service, i, int(active))
+
+		if states is not None:
+			for instance in relays:
+				relays[instance] = bool(states[instance])
 
 		# Activate or deactivate relays
-		for confservice, state in relays.items():
-			if (self._relaysList[confservice]['configured']):
-				self._switchRelay(self._relaysList[confservice]['state'], state)
+		now = self._now()
+		for instance, state in relays.items():
+			relay = self._relaysList[instance]
+			if relay.configured:
+				self._switchRelay(relay, self._constrain(relay, state, now))
+
+	# Returns the state the relay can have now: a switch is held back until the minimum
+	# on or off time passed, and switching on also until the start rate limit allows it.
+	# Only switching on takes from the rate limit, so that it never keeps a load running.
+	def _constrain(self, relay, state, now):
+		if relay.on is None or state == relay.on:
+			self._set_held(relay, False)
+			return state
+		if relay.on:
+			wait = self._getRelaySetting('MinOnTime', relay) - (now - relay.changed)
+		else:
+			wait = self._getRelaySetting('MinOffTime', relay) - (now - relay.changed)
+			starts = self._getRelaySetting('MaxStartsPerHour', relay)
+			if starts > 0:
+				relay.refill(now, starts)
+				wait = max(wait, (1 - relay.tokens) * 3600.0 / starts)
+		if wait <= 0:
+			self._set_held(relay, False)
+			return state
+		self._set_held(relay, True)
+		if not relay.timer:
+			relay.timer = True
+			self._add_timer(int(wait * 1000) + 1, self._relay_hold_expired, relay)
+		return relay.on
+
+	def _set_held(self, relay, held):
+		if relay.held == held:
+			return
+		relay.held = held
+		logger.info('Relay %s: %s', relay.instance, 'switch held back by its timing constraints' if held else 'no longer held')
+		path = '/Relay/{}/Held'.format(relay.instance)
+		if self.dbusservice is not None and path in self.dbusservice:
+			self.dbusservice[path] = int(held)
+
+	def _relay_hold_expired(self, relay):
+		relay.timer = False
+		if self.dbusservice is not None and relay.held:
+			self._checkRelay()
+		return False
+
+	# Only write real transitions, every write to the service may signal all its listeners.
+	# Returns whether the state was written.
+	def _publish_state(self, path, state):
+		if self.dbusservice[path] == state:
+			self.suppressedwrites += 1
+			return False
+		self.dbusservice[path] = state
+		return True
 
 	def _switchRelay(self, relay, state):
-		relayState = bool(self._dbusmonitor.get_value(relay.split('/')[0], '/' + relay.split('/', 1)[1]))
+		state = int(state)
+		if relay.pending is not None:
+			# Only one write per relay in flight, keep the last wanted state for later
+			relay.queued = state if state != relay.pending else None
+			return
+		relayState = bool(self._dbusmonitor.get_value(*relay.state))
 		if relayState != state:
-			logger.info('Switching relay %s: %s', relay, "Activated" if state else "Deactivated")
-			try:
-				self._dbusmonitor.set_value(relay.split('/')[0], '/' + relay.split('/', 1)[1], dbus.Int32(state, variant_level=1))
-			except:
-				logger.info('Error setting relay state')
+			logger.info('Switching relay %s: %s', relay.instance, "Activated" if state else "Deactivated")
+			now = self._now()
+			if self._trace is not None:
+				self._trace.relay(now, relay.instance, state)
+			if state:
+				starts = self._getRelaySetting('MaxStartsPerHour', relay)
+				if starts > 0:
+					relay.refill(now, starts)
+					relay.tokens -= 1
+			relay.on = state
+			relay.changed = now
+			relay.attempts = 0
+			self._write_relay(relay, state)
+
+	def _write_relay(self, relay, state):
+		relay.pending = state
+		relay.sequence += 1
+		sequence = relay.sequence
+		self._add_timer(RELAY_WRITE_TIMEOUT, self._relay_write_timeout, relay, sequence)
+		self._dbusmonitor.set_value_async(relay.state[0], relay.state[1], dbus.Int32(state, variant_level=1),
+			reply_handler=lambda *args: self._relay_written(relay, sequence),
+			error_handler=lambda error: self._relay_write_failed(relay, sequence, error))
+
+	def _relay_written(self, relay, sequence):
+		if sequence != relay.sequence or relay.pending is None:
+			return
+		relay.pending = None
+		relay.attempts = 0
+		if self._stats is not None:
+			self._stats.switches[relay.instance] = self._stats.switches.get(relay.instance, 0) + 1
+		self._write_queued(relay)
+
+	def _relay_write_failed(self, relay, sequence, error):
+		if sequence != relay.sequence or relay.pending is None:
+			return
+		logger.info('Error setting relay state: %s', error)
+		if self._stats is not None:
+			self._stats.failedwrites += 1
+		# Invalidate the timeout and any late reply of this write
+		relay.sequence += 1
+		if relay.attempts < RELAY_WRITE_RETRIES:
+			relay.attempts += 1
+			self._add_timer(RELAY_RETRY_DELAY, self._retry_relay_write, relay, relay.sequence)
+		else:
+			logger.info('Giving up setting relay %s after %s attempts', relay.instance, relay.attempts + 1)
+			relay.pending = None
+			relay.attempts = 0
+			self._write_queued(relay)
+
+	def _relay_write_timeout(self, relay, sequence):
+		self._relay_write_failed(relay, sequence, 'no reply')
+		return False
+
+	def _retry_relay_write(self, relay, sequence):
+		if sequence == relay.sequence and relay.pending is not None:
+			state = relay.pending if relay.queued is None else relay.queued
+			relay.queued = None
+			self._write_relay(relay, state)
+		return False
+
+	def _write_queued(self, relay):
+		if relay.queued is not None:
+			state = relay.queued
+			relay.queued = None
+			self._switchRelay(relay, state)
 
 
 if __name__ == '__main__':
+	import argparse
+	import signal
+
 	# Argument parsing
 	parser = argparse.ArgumentParser(
 		description='Close and open relay based on temperature sensors values'
@@ -454,6 +1733,17 @@ if __name__ == '__main__':
 
 	parser.add_argument('-d', '--debug', help='set logging level to debug',
 						action='store_true')
+	parser.add_argument('-c', '--conditions', help='number of conditions per temperature sensor',
+						type=int, default=2)
+	parser.add_argument('-b', '--batch', help='evaluate all sensors in one batched step (uses NumPy if available)',
+						action='store_true')
+	parser.add_argument('-s', '--stats', help='publish performance statistics under /Debug',
+						action='store_true')
+	parser.add_argument('--cache', help='file keeping the sensor state across restarts, empty to disable',
+						default=CACHE_FILE)
+	parser.add_argument('--trace', help='append the temperature readings, condition changes and relay switches to this file')
+	parser.add_argument('--dormant', help='only watch the relay functions until a relay is set to the temperature function',
+						action='store_true')
 	args = parser.parse_args()
 	logger = setup_logging(args.debug)
 
@@ -462,8 +1752,13 @@ if __name__ == '__main__':
 	# Have a mainloop, so we can send/receive asynchronous calls to and from dbus
 	DBusGMainLoop(set_as_default=True)
 
-	dbus_temp_relay = DBusTempSensorRelay()
+	dbus_temp_relay = DBusTempSensorRelay(conditions=args.conditions, batch=args.batch, stats=args.stats,
+		dormant=args.dormant, cache=args.cache, trace=args.trace)
 
-	# Start and run the mainloop
+	# Start and run the mainloop, stop it on SIGTERM so that the trace is complete
 	mainloop = GLib.MainLoop()
-	mainloop.run()
+	GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, mainloop.quit)
+	try:
+		mainloop.run()
+	finally:
+		dbus_temp_relay.close()
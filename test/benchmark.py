@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+from time import perf_counter
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(0, test_dir)
+from tempsensor_relay_test import MockTempRelay
+from mock_dbus_monitor import MockDbusMonitor
+from mock_dbus_service import MockDbusService
+import dbus_tempsensor_relay
+import mock_glib
+
+dbus_tempsensor_relay.GLib = mock_glib
+
+SIZES = [1, 10, 100, 1000]
+
+
+class CountingDbusService(MockDbusService):
+	def __init__(self, *args, **kwargs):
+		MockDbusService.__init__(self, *args, **kwargs)
+		self.writes = 0
+
+	def __setitem__(self, path, newvalue):
+		self.writes += 1
+		MockDbusService.__setitem__(self, path, newvalue)
+
+
+class CountingDbusMonitor(MockDbusMonitor):
+	def __init__(self, *args, **kwargs):
+		MockDbusMonitor.__init__(self, *args, **kwargs)
+		self.writes = 0
+
+	def set_value_async(self, serviceName, objectPath, value, reply_handler=None, error_handler=None):
+		self.writes += 1
+		return MockDbusMonitor.set_value_async(self, serviceName, objectPath, value,
+			reply_handler=reply_handler, error_handler=error_handler)
+
+
+# Measures the duration of each timer tick, and counts the writes to D-Bus
+class BenchTempRelay(MockTempRelay):
+	def __init__(self, *args, **kwargs):
+		self.durations = []
+		MockTempRelay.__init__(self, *args, **kwargs)
+
+	def _create_dbus_monitor(self, *args, **kwargs):
+		return CountingDbusMonitor(*args, **kwargs)
+
+	def _create_dbus_service(self):
+		return CountingDbusService('com.victronenergy.temprelay')
+
+	def _handletimertick(self):
+		start = perf_counter()
+		r = MockTempRelay._handletimertick(self)
+		self.durations.append(perf_counter() - start)
+		return r
+
+	@property
+	def writes(self):
+		return self._dbusmonitor.writes + (self.dbusservice.writes if self.dbusservice else 0)
+
+
+def add_device(monitor, service, values, instance=0):
+	values['/Connected'] = 1
+	values['/ProductName'] = 'dummy'
+	values['/Mgmt/Connection'] = 'dummy'
+	values.setdefault('/DeviceInstance', instance)
+	monitor.add_service(service, values)
+
+
+def sensor_services(sensors):
+	for i in range(sensors):
+		if i % 2:
+			yield 'com.victronenergy.battery.bench_{}'.format(i), '/Dc/0/Temperature'
+		else:
+			yield 'com.victronenergy.temperature.bench_{}'.format(i), '/Temperature'
+
+
+# Build a relay service with the given number of temperature and battery services,
+# each one with all its conditions configured
+def create_system(sensors, conditions=2, batch=False, seed=1):
+	rnd = random.Random(seed)
+	mock_glib.timer_manager.reset()
+	relay = BenchTempRelay(conditions=conditions, batch=batch)
+	monitor = relay._dbusmonitor
+	add_device(monitor, 'com.victronenergy.system', {'/Relay/0/State': 0, '/Relay/1/State': 0})
+	add_device(monitor, 'com.victronenergy.settings', {
+		'/Settings/Relay/Function': 4,
+		'/Settings/Relay/1/Function': 4})
+	for i, (service, path) in enumerate(sensor_services(sensors)):
+		add_device(monitor, service, {path: rnd.uniform(0, 40)}, instance=i)
+	relay._handletimertick()
+
+	settings = relay._settings
+	for i in range(sensors):
+		sensorId = 'bench_{}'.format(i)
+		settings['Enabled_' + sensorId] = 1
+		for c in range(conditions):
+			setValue = rnd.randint(0, 40)
+			settings['c{}Relay_{}'.format(c, sensorId)] = rnd.randint(0, 1)
+			settings['c{}SetValue_{}'.format(c, sensorId)] = setValue
+			settings['c{}ClearValue_{}'.format(c, sensorId)] = setValue + rnd.choice([-5, 5])
+	return relay
+
+
+def full_evaluation(relay):
+	if relay._batch is not None:
+		relay._evaluate_all()
+		return
+	for service in relay._statusList:
+		relay._checkTemp(service)
+		relay._checkValues(service)
+	relay._checkRelay()
+
+
+def bench_evaluation(sizes, conditions, repeat):
+	print('Full evaluation of all sensors, {} conditions each (backend: {})'.format(conditions,
+		'numpy' if dbus_tempsensor_relay.load_numpy() is not None else 'array'))
+	print('{:>8} {:>14} {:>14}'.format('sensors', 'scalar [ms]', 'batch [ms]'))
+	for size in sizes:
+		results = []
+		for batch in (False, True):
+			relay = create_system(size, conditions=conditions, batch=batch)
+			full_evaluation(relay)
+			t = min(timeit.repeat(lambda: full_evaluation(relay), number=1, repeat=repeat))
+			results.append(t * 1000)
+		print('{:>8} {:>14.3f} {:>14.3f}'.format(size, *results))
+
+
+# Every second, a random walk moves the temperature of each sensor with the given probability
+def simulate(relay, sensors, seconds, rate, seed=2):
+	rnd = random.Random(seed)
+	monitor = relay._dbusmonitor
+	services = list(sensor_services(sensors))
+	temperatures = dict((service, monitor.get_value(service, path)) for service, path in services)
+
+	def step():
+		start = perf_counter()
+		for service, path in services:
+			if rnd.random() < rate:
+				temperatures[service] += rnd.uniform(-1, 1)
+				monitor.set_value(service, path, round(temperatures[service], 1))
+		# Events are handled as they arrive, count them with the tick of that second
+		if relay.durations:
+			relay.durations[-1] += perf_counter() - start
+		return True
+
+	del relay.durations[:]
+	writes = relay.writes
+	mock_glib.timer_manager.add_timer(1000, step)
+	mock_glib.timer_manager.add_terminator(seconds * 1000 + 1)
+	mock_glib.timer_manager.start()
+	return relay.durations, relay.writes - writes
+
+
+def percentile(values, p):
+	return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def bench_ticks(sizes, conditions, batch, hours, rate):
+	seconds = int(hours * 3600)
+	print('Simulated {} s, {} conditions per sensor, {:.0f}% of the sensors change every second{}'.format(
+		seconds, conditions, rate * 100, ', batch evaluation' if batch else ''))
+	print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+		'sensors', 'p50 [us]', 'p99 [us]', 'max [us]', 'writes/s', 'alloc [KiB]', 'peak [KiB]'))
+	for size in sizes:
+		relay = create_system(size, conditions=conditions, batch=batch)
+		durations, writes = simulate(relay, size, seconds, rate)
+		durations = sorted(d * 1e6 for d in durations)
+
+		# Allocations over a shorter run, tracemalloc slows everything down
+		relay = create_system(size, conditions=conditions, batch=batch)
+		tracemalloc.start()
+		before = tracemalloc.get_traced_memory()[0]
+		simulate(relay, size, min(seconds, 600), rate)
+		current, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+
+		print('{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.2f} {:>12.1f} {:>12.1f}'.format(size,
+			percentile(durations, 50), percentile(durations, 99), durations[-1],
+			writes / float(seconds), (current - before) / 1024.0, (peak - before) / 1024.0))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmarks for dbus_tempsensor_relay')
+	parser.add_argument('-s', '--sizes', help='number of sensors to benchmark with',
+						type=int, nargs='+', default=SIZES)
+	parser.add_argument('-c', '--conditions', help='number of conditions per sensor',
+						type=int, default=2)
+	parser.add_argument('-r', '--repeat', help='number of repetitions per evaluation measurement',
+						type=int, default=20)
+	parser.add_argument('-H', '--hours', help='simulated time of the tick benchmark',
+						type=float, default=1)
+	parser.add_argument('--rate', help='probability of a sensor changing its temperature every second',
+						type=float, default=0.02)
+	parser.add_argument('-b', '--batch', help='use the batch evaluator in the tick benchmark',
+						action='store_true')
+	args = parser.parse_args()
+
+	bench_evaluation(args.sizes, args.conditions, args.repeat)
+	print('')
+	bench_ticks(args.sizes, args.conditions, args.batch, args.hours, args.rate)
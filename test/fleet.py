@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import sys
+from time import perf_counter
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(0, test_dir)
+from benchmark import add_device, percentile
+from tempsensor_relay_test import MockTempRelay
+from mock_dbus_monitor import MockDbusMonitor
+from dbus_tempsensor_relay import relay_function_path, relay_state_path
+import mock_glib
+
+RELAYS = (0, 1)  # Fan and heater
+
+
+# Keeps the number of switches and the time each relay was on
+class SiteDbusMonitor(MockDbusMonitor):
+	def __init__(self, *args, **kwargs):
+		MockDbusMonitor.__init__(self, *args, **kwargs)
+		self.timers = None
+		self.switches = dict.fromkeys(RELAYS, 0)
+		self.ontime = dict.fromkeys(RELAYS, 0)
+		self.since = {}  # Relay instance -> time it was switched on
+
+	def set_value_async(self, serviceName, objectPath, value, reply_handler=None, error_handler=None):
+		if serviceName == 'com.victronenergy.system':
+			self.switched(int(objectPath.split('/')[2]), int(value))
+		return MockDbusMonitor.set_value_async(self, serviceName, objectPath, value,
+			reply_handler=reply_handler, error_handler=error_handler)
+
+	def switched(self, instance, state):
+		now = self.timers.time
+		if state and instance not in self.since:
+			self.since[instance] = now
+			self.switches[instance] += 1
+		elif not state and instance in self.since:
+			self.ontime[instance] += now - self.since.pop(instance)
+			self.switches[instance] += 1
+
+
+class SiteTempRelay(MockTempRelay):
+	def _create_dbus_monitor(self, *args, **kwargs):
+		monitor = SiteDbusMonitor(*args, **kwargs)
+		monitor.timers = self.timers
+		return monitor
+
+
+# Daily cycle around a random mean, with a random amplitude and noise on every reading
+class SensorProfile(object):
+	def __init__(self, rnd):
+		self.rnd = rnd
+		self.mean = rnd.uniform(0, 35)
+		self.amplitude = rnd.uniform(2, 15)
+		self.phase = rnd.uniform(0, 2 * math.pi)
+		self.noise = rnd.uniform(0, 1.5)
+
+	def temperature(self, seconds):
+		t = self.mean + self.amplitude * math.sin(2 * math.pi * seconds / 86400 + self.phase)
+		return round(t + self.rnd.gauss(0, self.noise), 1)
+
+
+# Runs one installation with its own timer manager. Every sensor drives the fan with
+# condition 0 and the heater with condition 1.
+def simulate_site(params):
+	site, config = params
+	rnd = random.Random(config['seed'] * 100003 + site)
+	timers = mock_glib.MockTimerManager()
+	relay = SiteTempRelay(timers=timers)
+	monitor = relay._dbusmonitor
+	add_device(monitor, 'com.victronenergy.system', {relay_state_path(i): 0 for i in RELAYS})
+	add_device(monitor, 'com.victronenergy.settings', {relay_function_path(i): 4 for i in RELAYS})
+
+	sensors = []
+	for i in range(rnd.randint(1, config['sensors'])):
+		service = 'com.victronenergy.temperature.site{}_{}'.format(site, i)
+		profile = SensorProfile(rnd)
+		sensors.append((service, profile))
+		add_device(monitor, service, {'/Temperature': profile.temperature(0)}, instance=i)
+	timers.run_until(1000)
+
+	settings = relay._settings
+	fan = config['fan']
+	heater = config['heater']
+	for service, profile in sensors:
+		sensorId = relay._getSensorId(service)
+		settings['Enabled_' + sensorId] = 1
+		settings['Filter_' + sensorId] = config['filter'][0]
+		settings['FilterWindow_' + sensorId] = config['filter'][1]
+		for c, (setValue, clearValue) in enumerate((fan, heater)):
+			settings['c{}Relay_{}'.format(c, sensorId)] = RELAYS[c]
+			settings['c{}SetValue_{}'.format(c, sensorId)] = setValue
+			settings['c{}ClearValue_{}'.format(c, sensorId)] = clearValue
+
+	# Time above the set value of the fan, and below the set value of the heater
+	above = [0]
+	below = [0]
+	interval = config['interval']
+	start = timers.time
+
+	def step():
+		seconds = (timers.time - start) / 1000.0
+		for service, profile in sensors:
+			t = profile.temperature(seconds)
+			if t >= fan[0]:
+				above[0] += interval
+			if t <= heater[0]:
+				below[0] += interval
+			monitor.set_value(service, '/Temperature', t)
+		return True
+
+	seconds = int(config['hours'] * 3600)
+	timers.add_timer(interval * 1000, step)
+	timers.run_until(start + seconds * 1000)
+	for instance, since in monitor.since.items():
+		monitor.ontime[instance] += timers.time - since
+
+	sensorseconds = float(seconds * len(sensors))
+	return {
+		'duty': [monitor.ontime[i] / 1000.0 / seconds for i in RELAYS],
+		'switches': [monitor.switches[i] for i in RELAYS],
+		'above': above[0] / sensorseconds,
+		'below': below[0] / sensorseconds
+	}
+
+
+def summary(values):
+	values = sorted(values)
+	return '{:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}'.format(sum(values) / len(values),
+		percentile(values, 50), percentile(values, 95), values[-1])
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Simulates many installations with synthetic sensors')
+	parser.add_argument('-n', '--sites', help='number of installations', type=int, default=200)
+	parser.add_argument('-s', '--sensors', help='maximum number of sensors per installation', type=int, default=4)
+	parser.add_argument('-H', '--hours', help='simulated time', type=float, default=24)
+	parser.add_argument('-i', '--interval', help='seconds between two readings of a sensor', type=int, default=60)
+	parser.add_argument('--fan', help='set and clear value of the fan condition', type=float, nargs=2, default=[30, 25])
+	parser.add_argument('--heater', help='set and clear value of the heater condition', type=float, nargs=2, default=[5, 10])
+	parser.add_argument('--filter', help='filter and filter window of the sensors', type=int, nargs=2, default=[0, 10])
+	parser.add_argument('-j', '--jobs', help='number of processes, all cores by default', type=int, default=None)
+	parser.add_argument('--seed', help='seed of the synthetic profiles', type=int, default=1)
+	args = parser.parse_args()
+
+	config = {
+		'sensors': args.sensors,
+		'hours': args.hours,
+		'interval': args.interval,
+		'fan': args.fan,
+		'heater': args.heater,
+		'filter': args.filter,
+		'seed': args.seed
+	}
+	jobs = args.jobs or os.cpu_count()
+	start = perf_counter()
+	pool = multiprocessing.Pool(jobs)
+	results = pool.map(simulate_site, [(site, config) for site in range(args.sites)],
+		chunksize=max(1, args.sites // (jobs * 4)))
+	pool.close()
+	pool.join()
+	duration = perf_counter() - start
+
+	days = args.hours / 24.0
+	print('{} installations, {} h simulated in {:.1f} s on {} processes'.format(args.sites, args.hours, duration, jobs))
+	print('{:<28} {:>8} {:>8} {:>8} {:>8}'.format('', 'mean', 'p50', 'p95', 'max'))
+	for i, name in enumerate(('Fan', 'Heater')):
+		print('{:<28} {}'.format(name + ' duty cycle', summary([r['duty'][i] for r in results])))
+		print('{:<28} {}'.format(name + ' switches per day', summary([r['switches'][i] / days for r in results])))
+	print('{:<28} {}'.format('Time above fan set value', summary([r['above'] for r in results])))
+	print('{:<28} {}'.format('Time below heater set value', summary([r['below'] for r in results])))
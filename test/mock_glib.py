@@ -1,10 +1,15 @@
+import heapq
+
+
 class MockTimer(object):
-	def __init__(self, start, timeout, callback, *args, **kwargs):
+	def __init__(self, id, start, timeout, callback, *args, **kwargs):
+		self.id = id
 		self._timeout = timeout
 		self._next = start + timeout
 		self._callback = callback
 		self._args = args
 		self._kwargs = kwargs
+		self.cancelled = False
 
 	def run(self):
 		self._next += self._timeout
@@ -14,20 +19,36 @@ class MockTimer(object):
 	def next(self):
 		return self._next
 
+	# Timers due at the same time run in the order they were added
+	def __lt__(self, other):
+		return (self._next, self.id) < (other._next, other.id)
+
 
 class MockTimerManager(object):
 	def __init__(self):
-		self._timers = []
-		self._time = 0
+		self.reset()
 
+	# Returns the id of the timer, to be passed to source_remove
 	def add_timer(self, timeout, callback, *args, **kwargs):
-		self._timers.append(MockTimer(self._time, timeout, callback, *args, **kwargs))
+		self._ids += 1
+		timer = MockTimer(self._ids, self._time, timeout, callback, *args, **kwargs)
+		self._active[timer.id] = timer
+		heapq.heappush(self._timers, timer)
+		return timer.id
 
 	def add_idle(self, callback, *args, **kwargs):
-		self.add_timer(self._time, callback, *args, **kwargs)
+		return self.add_timer(self._time, callback, *args, **kwargs)
 
 	def add_terminator(self, timeout):
-		self.add_timer(timeout, self._terminate)
+		return self.add_timer(timeout, self._terminate)
+
+	def source_remove(self, id):
+		timer = self._active.pop(id, None)
+		if timer is None:
+			return False
+		# Left in the queue, skipped when it comes up
+		timer.cancelled = True
+		return True
 
 	def _terminate(self):
 		raise StopIteration()
@@ -36,24 +57,48 @@ class MockTimerManager(object):
 	def time(self):
 		return self._time
 
+	# Runs the first timer due, up to time 'until' if given. Returns False when there is
+	# none.
+	def _step(self, until=None):
+		timers = self._timers
+		while timers and timers[0].cancelled:
+			heapq.heappop(timers)
+		if not timers or (until is not None and timers[0].next > until):
+			return False
+		timer = heapq.heappop(timers)
+		self._time = timer.next
+		again = False
+		try:
+			again = timer.run()
+		finally:
+			if again and not timer.cancelled:
+				heapq.heappush(timers, timer)
+			else:
+				self._active.pop(timer.id, None)
+		return True
+
+	# Runs until a terminator fires or no timers are left
 	def start(self):
 		try:
-			while True:
-				next_timer = None
-				for t in self._timers:
-					if next_timer == None or t.next < next_timer.next:
-						next_timer = t
-				if next_timer == None:
-					return
-				self._time = next_timer.next
-				if not next_timer.run():
-					self._timers.remove(next_timer)
+			while self._step():
+				pass
 		except StopIteration:
-			self._timers.remove(next_timer)
 			pass
 
+	# Runs all timers due up to and including time 'until', in ms, and leaves the clock
+	# at that time. A terminator fired on the way stops it early.
+	def run_until(self, until):
+		try:
+			while self._step(until):
+				pass
+		except StopIteration:
+			return
+		self._time = max(self._time, until)
+
 	def reset(self):
 		self._timers = []
+		self._active = {}  # Id -> timer not removed yet
+		self._ids = 0
 		self._time = 0
 
 
@@ -61,15 +106,19 @@ timer_manager = MockTimerManager()
 
 
 def idle_add(callback, *args, **kwargs):
-	timer_manager.add_idle(callback, *args, **kwargs)
+	return timer_manager.add_idle(callback, *args, **kwargs)
 
 
 def timeout_add(timeout, callback, *args, **kwargs):
-	timer_manager.add_timer(timeout, callback, *args, **kwargs)
+	return timer_manager.add_timer(timeout, callback, *args, **kwargs)
 
 
 def timeout_add_seconds(timeout, callback, *args, **kwargs):
-	timeout_add(timeout * 1000, callback, *args, **kwargs)
+	return timeout_add(timeout * 1000, callback, *args, **kwargs)
+
+
+def source_remove(id):
+	return timer_manager.source_remove(id)
 
 
 def test_function(m, name):
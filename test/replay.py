@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+from time import perf_counter
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(0, test_dir)
+from benchmark import add_device
+from tempsensor_relay_test import MockTempRelay
+from mock_dbus_monitor import MockDbusMonitor
+import dbus_tempsensor_relay
+from dbus_tempsensor_relay import TraceRecorder, relay_function_path, relay_state_path
+import mock_glib
+
+dbus_tempsensor_relay.GLib = mock_glib
+
+
+# Keeps the relay switches as (time, relay instance, state)
+class ReplayDbusMonitor(MockDbusMonitor):
+	def __init__(self, *args, **kwargs):
+		MockDbusMonitor.__init__(self, *args, **kwargs)
+		self.timeline = []
+
+	def set_value_async(self, serviceName, objectPath, value, reply_handler=None, error_handler=None):
+		if serviceName == 'com.victronenergy.system':
+			instance = int(objectPath.split('/')[2])
+			self.timeline.append((mock_glib.timer_manager.time / 1000.0, instance, int(value)))
+		return MockDbusMonitor.set_value_async(self, serviceName, objectPath, value,
+			reply_handler=reply_handler, error_handler=error_handler)
+
+
+class ReplayTempRelay(MockTempRelay):
+	def _create_dbus_monitor(self, *args, **kwargs):
+		return ReplayDbusMonitor(*args, **kwargs)
+
+
+def run_until(seconds):
+	mock_glib.timer_manager.run_until(int(seconds * 1000))
+
+
+def temperature_path(service):
+	if 'com.victronenergy.battery' in service:
+		return '/Dc/0/Temperature'
+	return '/Temperature'
+
+
+# Applies the settings of the given sensor
+def apply_settings(relay, settings, service):
+	suffix = '_' + relay._getSensorId(service)
+	for name, v in settings.items():
+		if name.endswith(suffix):
+			relay._settings[name] = v
+
+
+# Feeds the temperature readings of a trace through the relay service, with the given
+# settings instead of the recorded ones. Returns the replayed and the recorded relay
+# switches, both as (time, relay instance, state) with the time since the start of
+# the replay. The runs in the trace are replayed one after the other.
+def replay(path, settings, relays=(0, 1), conditions=2, batch=False):
+	mock_glib.timer_manager.reset()
+	relay = ReplayTempRelay(conditions=conditions, batch=batch)
+	monitor = relay._dbusmonitor
+	add_device(monitor, 'com.victronenergy.system', {relay_state_path(i): 0 for i in relays})
+	add_device(monitor, 'com.victronenergy.settings', {relay_function_path(i): 4 for i in relays})
+	run_until(1)
+	# Virtual sensors are not in the trace, they are set up from the settings
+	for name, v in settings.items():
+		if name.startswith(('Function_virtual', 'Members_virtual')):
+			relay._settings[name] = v
+	for name in relay._virtual:
+		apply_settings(relay, settings, name)
+
+	recorded = []
+	offset = 0
+	last = 0
+	with open(path, 'rb') as f:
+		for kind, now, id, index, state, value in TraceRecorder.read(f):
+			if kind == TraceRecorder.START:
+				# Runs follow each other, the monotonic clock starts over on a reboot
+				offset = last - now + 1
+				continue
+			last = now + offset
+			run_until(last)
+			if kind == TraceRecorder.RELAY:
+				recorded.append((last, id, state))
+			elif kind == TraceRecorder.TEMPERATURE:
+				if id in relay._virtual:
+					continue
+				if id in monitor.get_service_list():
+					monitor.set_value(id, temperature_path(id), value)
+					continue
+				add_device(monitor, id, {temperature_path(id): value}, instance=len(monitor.get_service_list()))
+				apply_settings(relay, settings, id)
+	run_until(last + 1)
+	return monitor.timeline, recorded
+
+
+def parse_setting(s):
+	name, value = s.split('=', 1)
+	kind = name.split('_')[0]
+	if kind == 'Members':
+		return name, value
+	return name, float(value) if kind.endswith('Value') else int(value)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Replays a trace recorded with --trace against other settings')
+	parser.add_argument('trace', help='trace file')
+	parser.add_argument('-S', '--setting', help='setting to use, as <name>=<value> with the name used in localsettings, '
+						'for example c0SetValue_adc_builtin0_6=30', type=parse_setting, action='append', default=[])
+	parser.add_argument('-r', '--relays', help='relays set to the temperature function',
+						type=int, nargs='+', default=[0, 1])
+	parser.add_argument('-c', '--conditions', help='number of conditions per sensor',
+						type=int, default=2)
+	parser.add_argument('-b', '--batch', help='use the batch evaluator', action='store_true')
+	parser.add_argument('-q', '--quiet', help='only print the summary', action='store_true')
+	args = parser.parse_args()
+
+	start = perf_counter()
+	timeline, recorded = replay(args.trace, dict(args.setting), args.relays, args.conditions, args.batch)
+	duration = perf_counter() - start
+
+	if not args.quiet:
+		for t, instance, state in timeline:
+			print('{:>12.1f} relay {} {}'.format(t, instance, 'on' if state else 'off'))
+	simulated = mock_glib.timer_manager.time / 1000.0
+	print('Replayed {:.0f} s in {:.1f} s ({:.0f}x real time)'.format(simulated, duration, simulated / duration))
+	for instance in args.relays:
+		print('Relay {}: {} switches, {} recorded'.format(instance,
+			sum(1 for s in timeline if s[1] == instance), sum(1 for s in recorded if s[1] == instance)))
@@ -6,6 +6,9 @@ from time import sleep
 import datetime
 import calendar
 import logging
+import random
+import shutil
+import tempfile
 
 # our own packages
 test_dir = os.path.dirname(__file__)
@@ -20,7 +23,22 @@ from mock_settings_device import MockSettingsDevice
 
 dbus_tempsensor_relay.logger = logging.getLogger()
 
+# Not exported on a bus
+class MockHistoryObject(dbus_tempsensor_relay.HistoryObject):
+	def remove_from_connection(self, connection=None, path=None):
+		pass
+
+# The service calls __del__ when it goes off the bus
+class MockRelayDbusService(MockDbusService):
+	def __del__(self):
+		pass
+
 class MockTempRelay(dbus_tempsensor_relay.DBusTempSensorRelay):
+	# timers is the MockTimerManager running this instance, the module one by default
+	def __init__(self, *args, timers=None, **kwargs):
+		self.timers = mock_glib.timer_manager if timers is None else timers
+		dbus_tempsensor_relay.DBusTempSensorRelay.__init__(self, *args, **kwargs)
+
 
 	def _create_dbus_monitor(self, *args, **kwargs):
 		return MockDbusMonitor(*args, **kwargs)
@@ -30,16 +48,32 @@ class MockTempRelay(dbus_tempsensor_relay.DBusTempSensorRelay):
 		return self._settings
 
 	def _create_dbus_service(self):
-		return MockDbusService('com.victronenergy.temprelay')
+		return MockRelayDbusService('com.victronenergy.temprelay')
+
+	def _create_history_object(self):
+		return MockHistoryObject(None, self)
+
+	def _now(self):
+		return self.timers.time / 1000.0
+
+	def _add_timer(self, timeout, callback, *args):
+		self.timers.add_timer(timeout, callback, *args)
 
 
 class TestTempRelayBase(unittest.TestCase):
+	conditions = 2
+	batch = False
+	stats = False
+	cache = None
+	trace = None
+
 	def __init__(self, methodName='runTest'):
 		unittest.TestCase.__init__(self, methodName)
 
 	def setUp(self):
 		mock_glib.timer_manager.reset()
-		self._temprelay_ = MockTempRelay()
+		self._temprelay_ = MockTempRelay(conditions=self.conditions, batch=self.batch, stats=self.stats,
+			cache=self.cache, trace=self.trace)
 		self._monitor = self._temprelay_._dbusmonitor
 
 	def _update_values(self, interval=1000):
@@ -202,6 +236,46 @@ class TestTempRelay(TestTempRelayBase):
 			'/Sensor/ruuvi_c66a72222d16/1/State': 1
 			})
 
+	def test_remove_tempsensor(self):
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._update_values()
+		self._check_values({
+			'/Sensor/adc_builtin0_6/ServiceName': 'com.victronenergy.temperature.adc_builtin0_6',
+			'/Sensor/adc_builtin0_6/0/State': 0
+			})
+
+		self._remove_device('com.victronenergy.temperature.adc_builtin0_6')
+		self._update_values()
+		self.assertFalse('/Sensor/adc_builtin0_6/ServiceName' in self._service)
+		self.assertFalse('/Sensor/adc_builtin0_6/0/State' in self._service)
+
+		# Settings of the removed sensor are no longer published
+		self._set_setting('/Settings/TempSensorRelay/adc_builtin0_6/0/SetValue', 30)
+		self.assertFalse('/Sensor/adc_builtin0_6/0/SetValue' in self._service)
+
+	def test_battery_without_temp(self):
+		self._add_device('com.victronenergy.battery.ttyO1',
+			values={
+				'/Dc/0/Temperature': None,
+				'/System/MinCellTemperature': None,
+			}, instance=1)
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._update_values()
+		self.assertFalse('com.victronenergy.battery.ttyO1' in self._temprelay_._statusList)
+		self.assertFalse('/Sensor/ttyO1/Enabled' in self._service)
+
+		# Picked up once it publishes a temperature
+		self._monitor.set_value('com.victronenergy.battery.ttyO1', '/Dc/0/Temperature', 25)
+		self._update_values()
+		self._check_values({
+			'/Sensor/ttyO1/ServiceName': 'com.victronenergy.battery.ttyO1',
+			'/Sensor/ttyO1/0/State': 0
+			})
+
+		self._remove_device('com.victronenergy.battery.ttyO1')
+		self.assertFalse('com.victronenergy.battery.ttyO1' in self._temprelay_._statusList)
+		self.assertFalse('/Sensor/ttyO1/Enabled' in self._service)
+
 	def test_battery_service_with_temp(self):
 		self._update_values()
 		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/1/Function', 4)
@@ -473,6 +547,969 @@ class TestTempRelay(TestTempRelayBase):
 			'/Sensor/adc_builtin0_6/1/State': 0
 			})
 
+	def test_event_driven_evaluation(self):
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+		self._set_setting('/Settings/TempSensorRelay/adc_builtin0_6/Enabled', 1)
+		self._update_values()
+
+		self._set_value('/Sensor/adc_builtin0_6/0/Relay', 0)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 25)
+		self._update_values()
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 0
+			})
+
+		# A temperature change is acted upon without waiting for the timer
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 1
+			})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 1)
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 24)
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 0
+			})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 0)
+
+	def test_state_written_on_change_only(self):
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+		self._set_setting('/Settings/TempSensorRelay/adc_builtin0_6/Enabled', 1)
+		self._update_values()
+		self._set_value('/Sensor/adc_builtin0_6/0/Relay', 0)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 25)
+		self._update_values()
+
+		writes = []
+		setitem = self._service.__class__.__setitem__
+		def record(service, path, value):
+			writes.append(path)
+			setitem(service, path, value)
+		self._service.__class__ = type('RecordingService', (self._service.__class__,), {'__setitem__': record})
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 21)
+		self.assertFalse('/Sensor/adc_builtin0_6/0/State' in writes)
+
+		suppressed = self._temprelay_.suppressedwrites
+		self._temprelay_.fullevaluationpending = True
+		self._update_values()
+		self.assertFalse('/Sensor/adc_builtin0_6/0/State' in writes)
+		self.assertTrue(self._temprelay_.suppressedwrites > suppressed)
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self.assertEqual(writes.count('/Sensor/adc_builtin0_6/0/State'), 1)
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 1
+			})
+
+	def test_discovered_relay(self):
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+
+		# A third relay showing up at runtime
+		self._monitor.add_value('com.victronenergy.system', '/Relay/2/State', 0)
+		self._monitor.add_value('com.victronenergy.settings', '/Settings/Relay/2/Function', 0)
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/2/Function', 4)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self._set_setting('/Settings/TempSensorRelay/adc_builtin0_6/Enabled', 1)
+		self._update_values()
+
+		self._set_value('/Sensor/adc_builtin0_6/0/Relay', 2)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 25)
+		self._update_values()
+
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 1
+			})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 0)
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/2/State'), 1)
+
+		# Releasing the relay from the temperature function
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/2/Function', 0)
+		self._update_values()
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/2/State'), 0)
+
+	def test_relay_state_after_function(self):
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self._set_setting('/Settings/TempSensorRelay/adc_builtin0_6/Enabled', 1)
+		self._update_values()
+		self._set_value('/Sensor/adc_builtin0_6/0/Relay', 2)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 25)
+
+		# The function of a third relay is set first, its state only shows up later
+		self._monitor.add_value('com.victronenergy.settings', '/Settings/Relay/2/Function', 0)
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/2/Function', 4)
+		self._update_values()
+		self.assertFalse(2 in self._temprelay_._relaysList)
+
+		self._monitor.add_value('com.victronenergy.system', '/Relay/2/State', 0)
+		self._monitor.set_value('com.victronenergy.system', '/Relay/2/State', 0)
+		self._update_values()
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 1
+			})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/2/State'), 1)
+
+	def test_release_own_relays(self):
+		# A relay of the IO extender doing another job
+		self._monitor.add_value('com.victronenergy.settings', '/Settings/Relay/2/Function', 2)
+		self._monitor.add_value('com.victronenergy.system', '/Relay/2/State', 0)
+		self._monitor.set_value('com.victronenergy.system', '/Relay/2/State', 1)
+		self._setup_relay0_condition()
+		self.assertTrue(2 in self._temprelay_._relaysList)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self._update_values()
+		self.assertEqual(self._relay0_state(), 1)
+
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 0)
+		self._update_values()
+		self.assertIsNone(self._temprelay_.dbusservice)
+		self.assertEqual(self._relay0_state(), 0)
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/2/State'), 1)
+
+
+	def _setup_relay0_condition(self):
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+		self._set_setting('/Settings/TempSensorRelay/adc_builtin0_6/Enabled', 1)
+		self._update_values()
+		self._set_value('/Sensor/adc_builtin0_6/0/Relay', 0)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 25)
+		self._update_values()
+
+	def _relay0_state(self):
+		return self._monitor.get_value('com.victronenergy.system', '/Relay/0/State')
+
+	def test_min_on_time(self):
+		self._setup_relay0_condition()
+		self._set_value('/Relay/0/MinOnTime', 60)
+		self._set_value('/Relay/0/MinOffTime', 30)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 31)
+		self._update_values()
+		self.assertEqual(self._relay0_state(), 1)
+
+		# The condition clears, the relay stays on for the minimum on time
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+		self._update_values(30000)
+		self._check_values({'/Sensor/adc_builtin0_6/0/State': 0, '/Relay/0/Held': 1})
+		self.assertEqual(self._relay0_state(), 1)
+		self._update_values(31000)
+		self._check_values({'/Relay/0/Held': 0})
+		self.assertEqual(self._relay0_state(), 0)
+
+		# And off for the minimum off time
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 31)
+		self._update_values(20000)
+		self.assertEqual(self._relay0_state(), 0)
+		self._update_values(11000)
+		self.assertEqual(self._relay0_state(), 1)
+		self.assertEqual(self._temprelay_.settings['MinOnTime_relay0'], 60)
+
+	def test_max_starts_per_hour(self):
+		self._setup_relay0_condition()
+		self._set_value('/Relay/0/MaxStartsPerHour', 2)
+		starts = 0
+		for i in range(3):
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 31)
+			self._update_values()
+			starts += self._relay0_state()
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+			self._update_values()
+			self.assertEqual(self._relay0_state(), 0)
+		self.assertEqual(starts, 2)
+
+		# A start is available again after half an hour
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 31)
+		self._update_values(1700 * 1000)
+		self._check_values({'/Relay/0/Held': 1})
+		self._update_values(200 * 1000)
+		self._check_values({'/Relay/0/Held': 0})
+		self.assertEqual(self._relay0_state(), 1)
+
+	def test_history(self):
+		self._setup_relay0_condition()
+		history = self._temprelay_._historyobject
+		# Right after the end of an interval
+		self._update_values(60001 - mock_glib.timer_manager.time % 60000)
+		for t in (28, 31, 32):
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', t)
+			self._update_values(15000)
+		self._update_values(120000)
+
+		end, interval, intervals = dbus_tempsensor_relay.SensorHistory.unpack(history.GetHistory('adc_builtin0_6'))
+		self.assertEqual(interval, 60)
+		self.assertTrue(len(intervals) >= 3)
+		# 20 until the first reading, 1 ms after the start of the interval
+		low, high, mean, states = intervals[-2]
+		self.assertEqual((low, high, states), (20, 32, 1))
+		self.assertAlmostEqual(mean, (28 * 15 + 31 * 15 + 32 * 30) / 60.0, places=2)
+		# No reading in the last interval, the last one still holds
+		self.assertEqual(intervals[-1], (32, 32, 32, 1))
+		self.assertEqual(intervals[0][3], 0)
+		self.assertEqual(history.GetHistory('unknown'), b'')
+
+	# Lets the temperature fall by 0.1 degree every 10 s, returns the temperature at which
+	# the relay switched on
+	def _cool_down(self, lead):
+		self.setUp()
+		self._setup_relay0_condition()
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 5)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 10)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 12)
+		self._set_value('/Sensor/adc_builtin0_6/LeadTime', lead)
+		for k in range(100):
+			t = round(12 - 0.1 * k, 1)
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', t)
+			self._update_values(10000)
+			if self._relay0_state():
+				return t
+		return None
+
+	def test_trend_readings(self):
+		self._setup_relay0_condition()
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 12)
+		self._set_value('/Sensor/adc_builtin0_6/LeadTime', 600)
+		trend = self._temprelay_._statusList['com.victronenergy.temperature.adc_builtin0_6']['trend']
+		# Ticks and settings changes do not add the held reading again
+		self._update_values(60000)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 5)
+		self._update_values(60000)
+		self.assertEqual(len(trend.samples), 1)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 11)
+		self._update_values(60000)
+		self.assertEqual(len(trend.samples), 2)
+
+	def test_predictive_activation(self):
+		self.assertEqual(self._cool_down(0), 5)
+		# Six degrees ahead
+		t = self._cool_down(600)
+		self.assertTrue(10.8 <= t <= 11.2, t)
+		self._check_values({'/Sensor/adc_builtin0_6/LeadTime': 600, '/Sensor/adc_builtin0_6/0/State': 1})
+
+		# Stays on with the temperature steady between the set and the clear value
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 10.5)
+		self._update_values(60000)
+		self.assertEqual(self._relay0_state(), 1)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 9.5)
+		self._update_values(1200 * 1000)
+		self.assertEqual(self._relay0_state(), 1)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 10.5)
+		self._update_values()
+		self.assertEqual(self._relay0_state(), 0)
+
+	# Readings of a noisy sensor hovering around the set value, then really above it and below the clear value
+	NOISY_TRACE = [29.3, 30.0, 29.3, 29.2, 28.7, 29.3, 30.5, 29.9, 30.4, 29.7, 29.9, 29.7, 28.0, 30.3, 30.0,
+		29.9, 28.0, 27.9, 28.7, 29.1, 29.8, 29.5, 30.0, 28.9, 29.8, 29.9, 28.9, 31.0, 30.0, 30.6, 28.9, 28.8, 29.2,
+		29.4, 30.1, 29.7, 29.1, 28.6, 29.0, 30.6, 32.3, 33.2, 33.4, 31.7, 33.0, 34.2, 31.2, 32.7, 32.9, 32.3, 33.4,
+		32.9, 31.7, 33.7, 33.6, 33.9, 34.3, 33.3, 33.1, 31.8, 33.6, 32.4, 32.6, 31.9, 32.1, 32.5, 34.2, 31.2, 31.7,
+		33.2, 27.3, 26.5, 24.3, 23.7, 26.3, 25.3, 25.0, 26.9, 27.0, 26.1, 26.2, 26.4, 27.4, 26.6, 26.5, 26.5, 24.6,
+		27.2, 26.9, 26.5, 24.2, 25.4, 26.8, 24.4, 25.8, 26.9, 24.8, 27.4, 26.5, 25.9]
+
+	# Plays the trace at one reading per second, returns the number of relay switches
+	def _play_noisy_trace(self, mode, window=5):
+		self.setUp()
+		self._setup_relay0_condition()
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 29)
+		self._set_value('/Sensor/adc_builtin0_6/Filter', mode)
+		self._set_value('/Sensor/adc_builtin0_6/FilterWindow', window)
+		switches = 0
+		state = 0
+		for t in self.NOISY_TRACE:
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', t)
+			self._update_values()
+			if self._monitor.get_value('com.victronenergy.system', '/Relay/0/State') != state:
+				state = 1 - state
+				switches += 1
+		self.assertEqual(state, 0)
+		return switches
+
+	def test_filtered_noisy_trace(self):
+		Filter = dbus_tempsensor_relay.TemperatureFilter
+		raw = self._play_noisy_trace(Filter.NONE)
+		self.assertTrue(raw > 2)
+		for mode in (Filter.EMA, Filter.MEDIAN, Filter.DWELL):
+			switches = self._play_noisy_trace(mode)
+			# Still switched on and off by the real change
+			self.assertTrue(2 <= switches < raw, (mode, switches, raw))
+
+	def test_out_of_range_setting(self):
+		self._setup_relay0_condition()
+		self._set_value('/Sensor/adc_builtin0_6/Filter', dbus_tempsensor_relay.TemperatureFilter.EMA)
+		for path, value in (('/Sensor/adc_builtin0_6/FilterWindow', 0), ('/Sensor/adc_builtin0_6/0/SetValue', 150),
+				('/Sensor/adc_builtin0_6/0/Relay', -2), ('/Relay/0/MinOnTime', 86401), ('/Sensor/adc_builtin0_6/0/ClearValue', 'x')):
+			before = self._service[path]
+			self._set_value(path, value)
+			self._update_values()
+			self._check_values({path: before})
+		self.assertEqual(self._temprelay_._pendingSettings, {})
+
+		# Still evaluated with the old values
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 35)
+		self._update_values(60000)
+		self._check_values({'/Sensor/adc_builtin0_6/0/State': 1})
+		self.assertEqual(self._relay0_state(), 1)
+
+		self._setup_relay0_condition()
+		self._set_value('/Sensor/adc_builtin0_6/Filter', dbus_tempsensor_relay.TemperatureFilter.MEDIAN)
+		self._set_value('/Sensor/adc_builtin0_6/FilterWindow', 3)
+		for t in (20, 21):
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', t)
+			self._update_values()
+
+		# A spike that holds for a while is still one reading
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 40)
+		self._update_values(10000)
+		self._check_values({'/Sensor/adc_builtin0_6/0/State': 0})
+		self.assertEqual(self._relay0_state(), 0)
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 39)
+		self._update_values()
+		self._check_values({'/Sensor/adc_builtin0_6/0/State': 1})
+
+	def test_fractional_thresholds(self):
+		self._setup_relay0_condition()
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30.5)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 30.2)
+		self._update_values()
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/SetValue': 30.5,
+			'/Sensor/adc_builtin0_6/0/ClearValue': 30.2
+			})
+
+		for t, state in ((30.4, 0), (30.5, 1), (30.3, 1), (30.2, 0), (30.49, 0), (30.499, 0), (30.5, 1)):
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', t)
+			self._update_values()
+			self._check_values({'/Sensor/adc_builtin0_6/0/State': state})
+		self.assertEqual(self._temprelay_._settings['c0SetValue_adc_builtin0_6'], 30.5)
+
+		# Just below an integer set value is not reaching it, exactly on it is
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 0)
+		self._update_values()
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 0.29)
+		for t, state in ((0, 0), (29.996, 0), (30, 1), (0.3, 1), (0.29, 0)):
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', t)
+			self._update_values()
+			self._check_values({'/Sensor/adc_builtin0_6/0/State': state})
+
+	def test_virtual_sensor(self):
+		self._add_device('com.victronenergy.battery.ttyO1',
+			values={
+				'/Dc/0/Temperature': 20,
+				'/System/MinCellTemperature': None,
+			}, instance=1)
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._update_values()
+		self._set_setting('/Settings/TempSensorRelay/virtual0/Members', 'socketcan_vecan0_1, ttyO1')
+		self._set_setting('/Settings/TempSensorRelay/virtual0/Function', dbus_tempsensor_relay.VirtualSensor.MAX)
+		self._set_setting('/Settings/TempSensorRelay/virtual0/Enabled', 1)
+		self._set_value('/Sensor/virtual0/0/Relay', 0)
+		self._set_value('/Sensor/virtual0/0/SetValue', 30)
+		self._set_value('/Sensor/virtual0/0/ClearValue', 25)
+		self._update_values()
+		self._check_values({
+			'/Sensor/virtual0/ServiceName': 'virtual0',
+			'/Sensor/virtual0/0/State': 0
+			})
+
+		# The warmest battery drives the relay
+		self._monitor.set_value('com.victronenergy.battery.ttyO1', '/Dc/0/Temperature', 31)
+		self._update_values()
+		self._check_values({'/Sensor/virtual0/0/State': 1})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 1)
+
+		self._monitor.set_value('com.victronenergy.battery.socketcan_vecan0_1', '/System/MinCellTemperature', 28)
+		self._monitor.set_value('com.victronenergy.battery.ttyO1', '/Dc/0/Temperature', 20)
+		self._update_values()
+		self._check_values({'/Sensor/virtual0/0/State': 1})
+
+		self._remove_device('com.victronenergy.battery.socketcan_vecan0_1')
+		self._update_values()
+		self._check_values({'/Sensor/virtual0/0/State': 0})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 0)
+
+		self._set_setting('/Settings/TempSensorRelay/virtual0/Function', dbus_tempsensor_relay.VirtualSensor.NONE)
+		self.assertFalse('/Sensor/virtual0/Enabled' in self._service)
+
+	def test_own_timer_manager(self):
+		timers = mock_glib.MockTimerManager()
+		relay = MockTempRelay(conditions=self.conditions, timers=timers)
+		monitor = relay._dbusmonitor
+		monitor.add_service('com.victronenergy.system', {'/Relay/0/State': 0})
+		monitor.add_service('com.victronenergy.settings', {'/Settings/Relay/Function': 4})
+		monitor.add_service('com.victronenergy.temperature.adc_builtin0_6', {'/Temperature': 15})
+		timers.add_terminator(5000)
+		timers.start()
+
+		self.assertEqual(timers.time, 5000)
+		self.assertEqual(mock_glib.timer_manager.time, 0)
+		self.assertIsNotNone(relay.dbusservice)
+		self.assertIsNone(self._temprelay_.dbusservice)
+
+	def test_relay_write_retry(self):
+		self._setup_relay0_condition()
+
+		failures = [2]
+		set_value_async = self._monitor.set_value_async
+		def failing_set_value_async(service, path, value, reply_handler=None, error_handler=None):
+			if failures[0] > 0:
+				failures[0] -= 1
+				error_handler(Exception('busy'))
+				return
+			set_value_async(service, path, value, reply_handler=reply_handler, error_handler=error_handler)
+		self._monitor.set_value_async = failing_set_value_async
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 0)
+		self._update_values(3000)
+		self.assertEqual(failures[0], 0)
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 1)
+
+	def test_relay_write_timeout(self):
+		self._setup_relay0_condition()
+
+		calls = []
+		set_value_async = self._monitor.set_value_async
+		def slow_set_value_async(service, path, value, reply_handler=None, error_handler=None):
+			calls.append(value)
+			# The first write never gets a reply
+			if len(calls) > 1:
+				set_value_async(service, path, value, reply_handler=reply_handler, error_handler=error_handler)
+		self._monitor.set_value_async = slow_set_value_async
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self._update_values(dbus_tempsensor_relay.RELAY_WRITE_TIMEOUT + dbus_tempsensor_relay.RELAY_RETRY_DELAY + 1000)
+		self.assertEqual(calls, [1, 1])
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 1)
+
+	def test_relay_writes_merged(self):
+		self._setup_relay0_condition()
+
+		calls = []
+		def pending_set_value_async(service, path, value, reply_handler=None, error_handler=None):
+			calls.append((path, value, reply_handler))
+		self._monitor.set_value_async = pending_set_value_async
+
+		# While the first write is in flight, later changes are merged
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self.assertEqual([(path, value) for path, value, handler in calls], [('/Relay/0/State', 1)])
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+		self._monitor.set_value('com.victronenergy.system', '/Relay/0/State', 1)
+		calls[0][2]()
+		self.assertEqual([(path, value) for path, value, handler in calls], [('/Relay/0/State', 1), ('/Relay/0/State', 0)])
+
+	def test_settings_writes_coalesced(self):
+		self._setup_relay0_condition()
+
+		writes = []
+		settings = self._temprelay_._settings
+		setitem = settings.__class__.__setitem__
+		def record(settings, setting, value):
+			writes.append((setting, value))
+			setitem(settings, setting, value)
+		settings.__class__ = type('RecordingSettings', (settings.__class__,), {'__setitem__': record})
+
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 18)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 19)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 15)
+		self._set_value('/Sensor/adc_builtin0_6/1/Relay', 1)
+		self._set_value('/Sensor/adc_builtin0_6/1/Relay', -1)
+
+		# The new values are used right away, localsettings is written later
+		self.assertEqual(writes, [])
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/SetValue': 19,
+			'/Sensor/adc_builtin0_6/0/State': 1
+			})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 1)
+
+		self._update_values()
+		self.assertEqual(sorted(writes), [('c0ClearValue_adc_builtin0_6', 15), ('c0SetValue_adc_builtin0_6', 19)])
+		self.assertEqual(self._temprelay_._settings['c0SetValue_adc_builtin0_6'], 19)
+
+	def test_bulk_settings_registration(self):
+		for i in range(3):
+			self._add_device('com.victronenergy.temperature.adc_builtin0_{}'.format(i),
+				values={'/Temperature': 20}, instance=i)
+
+		calls = []
+		settings = self._temprelay_._settings
+		addSettings = settings.addSettings
+		def record(s):
+			calls.append(sorted(s))
+			addSettings(s)
+		settings.addSettings = record
+
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._update_values(3000)
+
+		# One round trip to localsettings for all 5 sensors
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(len(calls[0]), 5 * (4 + 3 * self.conditions))
+		self.assertEqual(len(self._temprelay_._statusList), 5)
+		self._check_values({'/Sensor/adc_builtin0_2/Enabled': 0})
+		self.assertIsNotNone(self._temprelay_.startuptime)
+
+
+class TestTempRelayDormant(TestTempRelayBase):
+	def setUp(self):
+		mock_glib.timer_manager.reset()
+		self._temprelay_ = MockTempRelay(conditions=self.conditions, dormant=True)
+		self._monitor = self._temprelay_._dormantmonitor
+		self._service = None
+		self._add_device('com.victronenergy.settings',
+			values={
+				'/Settings/Relay/Function': 0,
+				'/Settings/Relay/1/Function': 1
+			})
+
+	def test_dormant(self):
+		self._update_values(3000)
+		self.assertIsNone(self._temprelay_._dbusmonitor)
+		self.assertFalse(hasattr(self._temprelay_, 'settings'))
+		self.assertIsNone(self._temprelay_.dbusservice)
+
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/1/Function', 4)
+		self.assertIsNotNone(self._temprelay_._dbusmonitor)
+		self.assertIsNotNone(self._temprelay_.settings)
+
+		# The full monitor finds the services on the bus
+		self._monitor = self._temprelay_._dbusmonitor
+		self._add_device('com.victronenergy.system', values={'/Relay/0/State': 0, '/Relay/1/State': 0})
+		self._add_device('com.victronenergy.settings',
+			values={
+				'/Settings/Relay/Function': 0,
+				'/Settings/Relay/1/Function': 4
+			})
+		self._add_device('com.victronenergy.temperature.adc_builtin0_6', values={'/Temperature': 20})
+		self._update_values(3000)
+		self._service = self._temprelay_.dbusservice
+		self._check_values({'/Sensor/adc_builtin0_6/Enabled': 0})
+
+		# Changes seen by the small monitor are ignored once started
+		monitor = self._temprelay_._dbusmonitor
+		self._temprelay_._dormantmonitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self.assertIs(self._temprelay_._dbusmonitor, monitor)
+
+
+class TestTempRelayThreeConditions(TestTempRelay):
+	conditions = 3
+
+	def test_third_condition(self):
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/1/Function', 4)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+		self._set_setting('/Settings/TempSensorRelay/adc_builtin0_6/Enabled', 1)
+		self._update_values()
+
+		# Fan stage 1, fan stage 2 and heater
+		self._set_value('/Sensor/adc_builtin0_6/0/Relay', 0)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 25)
+		self._set_value('/Sensor/adc_builtin0_6/1/Relay', 0)
+		self._set_value('/Sensor/adc_builtin0_6/1/SetValue', 40)
+		self._set_value('/Sensor/adc_builtin0_6/1/ClearValue', 35)
+		self._set_value('/Sensor/adc_builtin0_6/2/Relay', 1)
+		self._set_value('/Sensor/adc_builtin0_6/2/SetValue', 5)
+		self._set_value('/Sensor/adc_builtin0_6/2/ClearValue', 10)
+		self._update_values()
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 0,
+			'/Sensor/adc_builtin0_6/1/State': 0,
+			'/Sensor/adc_builtin0_6/2/State': 0
+			})
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 42)
+		self._update_values()
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 1,
+			'/Sensor/adc_builtin0_6/1/State': 1,
+			'/Sensor/adc_builtin0_6/2/State': 0
+			})
+
+		# Stage 2 clears, stage 1 keeps the relay closed
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 33)
+		self._update_values()
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 1,
+			'/Sensor/adc_builtin0_6/1/State': 0,
+			'/Sensor/adc_builtin0_6/2/State': 0
+			})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 1)
+
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 3)
+		self._update_values()
+		self._check_values({
+			'/Sensor/adc_builtin0_6/0/State': 0,
+			'/Sensor/adc_builtin0_6/1/State': 0,
+			'/Sensor/adc_builtin0_6/2/State': 1
+			})
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/0/State'), 0)
+		self.assertEqual(self._monitor.get_value('com.victronenergy.system', '/Relay/1/State'), 1)
+
+
+class TestTempRelayStats(TestTempRelay):
+	stats = True
+
+	def test_stats(self):
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 20)
+		self._set_setting('/Settings/TempSensorRelay/adc_builtin0_6/Enabled', 1)
+		self._update_values()
+		self._set_value('/Sensor/adc_builtin0_6/0/Relay', 0)
+		self._set_value('/Sensor/adc_builtin0_6/0/SetValue', 30)
+		self._set_value('/Sensor/adc_builtin0_6/0/ClearValue', 25)
+
+		for t in (32, 20, 32, 20):
+			self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', t)
+			self._update_values()
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', None)
+		self._update_values(10000)
+
+		self.assertEqual(self._service['/Debug/Relay/0/Switches'], 4)
+		self.assertEqual(self._service['/Debug/SensorsRetrying'], 1)
+		self.assertEqual(self._service['/Debug/FailedRelayWrites'], 0)
+		self.assertTrue(self._service['/Debug/TickDuration/Max'] >= self._service['/Debug/TickDuration/Mean'])
+		# The readings are handled as they come in, not by the timer
+		self.assertTrue(len(self._temprelay_._stats.eventdurations) >= 5)
+		self.assertTrue(self._service['/Debug/EvaluationDuration/Max'] >= self._service['/Debug/EvaluationDuration/Mean'])
+		self.assertTrue(self._service['/Debug/EvaluationsPerSecond'] > 0)
+
+
+class TestTempRelayBatch(TestTempRelay):
+	batch = True
+
+	def setUp(self):
+		TestTempRelay.setUp(self)
+		# Make every tick a full evaluation, so all of it goes through the batch evaluator
+		dbus_tempsensor_relay.FULL_EVALUATION_TICKS = 1
+
+	def tearDown(self):
+		dbus_tempsensor_relay.FULL_EVALUATION_TICKS = 60
+
+
+class TestTempRelayCache(TestTempRelay):
+	def setUp(self):
+		self._cachedir = tempfile.mkdtemp()
+		self.cache = os.path.join(self._cachedir, 'cache')
+		TestTempRelay.setUp(self)
+
+	def tearDown(self):
+		shutil.rmtree(self._cachedir)
+
+	# Starts a new instance, dropping the timers of the running one
+	def _restart(self):
+		TestTempRelay.setUp(self)
+		self._monitor.set_value('com.victronenergy.system', '/Relay/0/State', 1)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 28)
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		# The settings of the mock do not survive the restart, look before evaluating
+		return self._temprelay_._statusList['com.victronenergy.temperature.adc_builtin0_6']
+
+	def _setup_active_condition(self):
+		self._setup_relay0_condition()
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 32)
+		self._monitor.set_value('com.victronenergy.temperature.adc_builtin0_6', '/Temperature', 28)
+		self._update_values(dbus_tempsensor_relay.CACHE_INTERVAL * 1000)
+		self._check_values({'/Sensor/adc_builtin0_6/0/State': 1})
+
+	def test_warm_start(self):
+		self._setup_active_condition()
+		cache = self._temprelay_._cache
+		self.assertTrue(os.path.exists(self.cache))
+		self.assertFalse(cache.save(self._temprelay_._statusList, cache.savedat + 1))
+
+		status = self._restart()
+		self.assertEqual(status['temperature'], 28)
+		self.assertEqual(list(status['conditions'].active), [1, 0])
+
+	def test_stale_cache(self):
+		self._setup_active_condition()
+		service = 'com.victronenergy.temperature.adc_builtin0_6'
+		cache = dbus_tempsensor_relay.StateCache(self.cache, self.conditions)
+		cache.load()
+		self.assertEqual(cache.restore(service, cache.timestamp + 10), (28, b'\x01\x00'))
+		cache.load()
+		self.assertIsNone(cache.restore(service, cache.timestamp + dbus_tempsensor_relay.CACHE_MAX_AGE + 10))
+
+		# Written for another number of conditions
+		cache = dbus_tempsensor_relay.StateCache(self.cache, self.conditions + 1)
+		cache.load()
+		self.assertEqual(cache.entries, {})
+
+
+class TestTempRelayTrace(TestTempRelay):
+	# Tests that start over call setUp again, that run goes on in the same trace
+	def setUp(self):
+		if hasattr(self, '_tracedir'):
+			self._temprelay_.close()
+		else:
+			self._tracedir = tempfile.mkdtemp()
+			self.trace = os.path.join(self._tracedir, 'trace')
+		TestTempRelay.setUp(self)
+
+	def tearDown(self):
+		self._temprelay_.close()
+		shutil.rmtree(self._tracedir)
+
+	def _read_trace(self):
+		self._temprelay_._trace.flush()
+		with open(self.trace, 'rb') as f:
+			return list(dbus_tempsensor_relay.TraceRecorder.read(f))
+
+	def test_trace(self):
+		Trace = dbus_tempsensor_relay.TraceRecorder
+		service = 'com.victronenergy.temperature.adc_builtin0_6'
+		self._setup_relay0_condition()
+		# The repeated reading is recorded once
+		for t in (32, 32, 20, None):
+			self._monitor.set_value(service, '/Temperature', t)
+			self._update_values()
+
+		records = [r for r in self._read_trace() if r[0] != Trace.TEMPERATURE or r[2] == service]
+		self.assertEqual(records[0][0], Trace.START)
+		self.assertEqual([(r[0], r[1], r[2], r[5]) for r in records if r[0] == Trace.TEMPERATURE][-3:],
+			[(Trace.TEMPERATURE, 2, service, 32), (Trace.TEMPERATURE, 4, service, 20), (Trace.TEMPERATURE, 5, service, None)])
+		self.assertEqual([r[1:5] for r in records if r[0] == Trace.CONDITION], [(2, service, 0, 1), (4, service, 0, 0)])
+		self.assertEqual([r[1:5] for r in records if r[0] == Trace.RELAY], [(2, 0, 0, 1), (4, 0, 0, 0)])
+
+		# A restart appends a new run to the same file
+		self.setUp()
+		self._setup_relay0_condition()
+		starts = [r for r in self._read_trace() if r[0] == Trace.START]
+		self.assertEqual(len(starts), 2)
+
+	def test_replay_virtual_sensor(self):
+		import replay
+		self._add_device('com.victronenergy.battery.ttyO1', values={'/Dc/0/Temperature': 20}, instance=1)
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/Relay/Function', 4)
+		self._update_values()
+		settings = {
+			'Members_virtual0': 'ttyO1',
+			'Function_virtual0': dbus_tempsensor_relay.VirtualSensor.MAX,
+			'Enabled_virtual0': 1,
+			'c0Relay_virtual0': 0,
+			'c0SetValue_virtual0': 30,
+			'c0ClearValue_virtual0': 25
+		}
+		for name, value in settings.items():
+			self._temprelay_._settings[name] = value
+		for t in (31, 20):
+			self._monitor.set_value('com.victronenergy.battery.ttyO1', '/Dc/0/Temperature', t)
+			self._update_values()
+		self._temprelay_.close()
+
+		timeline, recorded = replay.replay(self.trace, settings, relays=(0,))
+		self.assertEqual(len(recorded), 2)
+		self.assertEqual([r[1:] for r in timeline], [r[1:] for r in recorded])
+
+	def test_first_reading_zero(self):
+		Trace = dbus_tempsensor_relay.TraceRecorder
+		path = os.path.join(self._tracedir, 'zero')
+		trace = Trace(path, 1.0)
+		for now, t in ((2.0, 0.0), (3.0, 0.0), (4.0, 0)):
+			trace.temperature(now, 'com.victronenergy.temperature.frost', t)
+		trace.close()
+		with open(path, 'rb') as f:
+			records = [r for r in Trace.read(f) if r[0] == Trace.TEMPERATURE]
+		self.assertEqual([(r[1], r[5]) for r in records], [(2.0, 0.0)])
+
+
+class TestMockTimerManager(unittest.TestCase):
+	def test_order(self):
+		timers = mock_glib.MockTimerManager()
+		calls = []
+		def timer(name, times):
+			calls.append((timers.time, name))
+			return len([c for c in calls if c[1] == name]) < times
+		timers.add_timer(200, timer, 'a', 3)
+		timers.add_timer(100, timer, 'b', 10)
+		timers.add_timer(200, timer, 'c', 1)
+		timers.add_terminator(450)
+		timers.start()
+		self.assertEqual(calls, [(100, 'b'), (200, 'a'), (200, 'b'), (200, 'c'), (300, 'b'), (400, 'a'), (400, 'b')])
+		self.assertEqual(timers.time, 450)
+
+	def test_source_remove(self):
+		timers = mock_glib.MockTimerManager()
+		calls = []
+		a = timers.add_timer(100, lambda: calls.append('a') or True)
+		b = timers.add_timer(100, lambda: calls.append('b') or timers.source_remove(b))
+		timers.run_until(250)
+		self.assertEqual(calls, ['a', 'b', 'a'])
+		self.assertTrue(timers.source_remove(a))
+		self.assertFalse(timers.source_remove(a))
+		self.assertFalse(timers.source_remove(b))
+		timers.run_until(1000)
+		self.assertEqual(calls, ['a', 'b', 'a'])
+		self.assertEqual(timers.time, 1000)
+
+	def test_run_until(self):
+		timers = mock_glib.MockTimerManager()
+		calls = []
+		timers.add_timer(1000, lambda: calls.append(timers.time) or True)
+		timers.run_until(3000)
+		self.assertEqual(calls, [1000, 2000, 3000])
+		timers.run_until(3500)
+		self.assertEqual(timers.time, 3500)
+		self.assertEqual(calls, [1000, 2000, 3000])
+
+		# A terminator on the way stops early
+		timers.add_terminator(1000)
+		timers.run_until(10000)
+		self.assertEqual(timers.time, 4500)
+		self.assertEqual(calls, [1000, 2000, 3000, 4000])
+
+
+class TestVirtualSensor(unittest.TestCase):
+	def test_incremental(self):
+		rnd = random.Random(1)
+		VirtualSensor = dbus_tempsensor_relay.VirtualSensor
+		members = ['battery{}'.format(i) for i in range(12)]
+		for function, aggregate in ((VirtualSensor.MIN, min), (VirtualSensor.MAX, max),
+				(VirtualSensor.MEAN, lambda v: sum(v) / len(v))):
+			virtual = VirtualSensor(function, set(members))
+			values = {}
+			for step in range(500):
+				member = rnd.choice(members)
+				temperature = rnd.choice([None, round(rnd.uniform(-10, 40), 2)])
+				virtual.update(member, temperature)
+				values[member] = temperature
+				valid = [v for v in values.values() if v is not None]
+				if valid:
+					self.assertAlmostEqual(virtual.value(), aggregate(valid), places=6)
+				else:
+					self.assertIsNone(virtual.value())
+			self.assertTrue(len(virtual.heap) <= 4 * len(members) + 17)
+
+
+class TestTemperatureFilter(unittest.TestCase):
+	def test_empty_window(self):
+		Filter = dbus_tempsensor_relay.TemperatureFilter
+		for mode in (Filter.EMA, Filter.MEDIAN, Filter.DWELL):
+			filt = Filter(mode, 0, 2)
+			self.assertEqual(filt.window, 1)
+			self.assertEqual(filt.update(20.0, 1000.0), 20.0)
+			self.assertEqual(filt.update(22.0, 1000.0), 22.0 if mode != Filter.EMA else 20.0)
+
+
+class TestTemperatureTrend(unittest.TestCase):
+	def test_slope(self):
+		rnd = random.Random(2)
+		trend = dbus_tempsensor_relay.TemperatureTrend(300, window=600)
+		self.assertIsNone(trend.slope())
+		now = 1000.0
+		readings = []
+		for i in range(2000):
+			now += rnd.uniform(1, 20)
+			y = 20 + 0.002 * now + rnd.gauss(0, 0.2)
+			trend.update(now, y)
+			readings.append((now, y))
+			window = [(t, v) for t, v in readings if t >= now - 600]
+			n = len(window)
+			if n < 3 or window[-1][0] - window[0][0] < 60:
+				self.assertIsNone(trend.slope())
+				continue
+			mx = sum(t for t, v in window) / n
+			my = sum(v for t, v in window) / n
+			expected = (sum((t - mx) * (v - my) for t, v in window) /
+				sum((t - mx) ** 2 for t, v in window))
+			self.assertAlmostEqual(trend.slope(), expected, places=9)
+		self.assertAlmostEqual(trend.projected(), y + 300 * expected)
+
+		# An invalid reading starts over
+		trend.update(now + 1, None)
+		self.assertIsNone(trend.projected())
+
+		# Without what was fitted before it
+		for i in range(10):
+			trend.update(now + 10 * (i + 2), 10.0)
+		self.assertAlmostEqual(trend.slope(), 0.0)
+		self.assertAlmostEqual(trend.projected(), 10.0)
+
+
+class TestSensorHistory(unittest.TestCase):
+	def test_ring(self):
+		SensorHistory = dbus_tempsensor_relay.SensorHistory
+		history = SensorHistory(length=5)
+		self.assertEqual(SensorHistory.unpack(history.pack(1000)), (1000, 60, []))
+		for i in range(7):
+			history.sample(60 * i, i, [0, 0])
+			history.sample(60 * i + 15, i + 1, [i % 2, 0])
+			history.close(60 * i + 60, [0, 1])
+		history.sample(420, None, [0, 0])
+		history.close(480, [0, 0])
+		history.close(540, [0, 0])
+		end, interval, intervals = SensorHistory.unpack(history.pack(2000))
+		self.assertEqual(end, 2000)
+		self.assertEqual(len(intervals), 5)
+		self.assertEqual(intervals[:3], [(4, 5, 4.75, 2), (5, 6, 5.75, 3), (6, 7, 6.75, 2)])
+		# The reading went invalid at the start of the interval
+		self.assertEqual(intervals[-2:], [(7, 7, 7, 0), (None, None, None, 0)])
+		self.assertEqual(len(history.pack(2000)), SensorHistory.HEADER.size + 5 * 7)
+
+
+class TestBatchEvaluator(unittest.TestCase):
+	def _check_backend(self, use_numpy):
+		rnd = random.Random(1)
+		inRange = dbus_tempsensor_relay.DBusTempSensorRelay._inRange
+		configured = [True, True, False, True]
+
+		tables = []
+		for i in range(50):
+			table = dbus_tempsensor_relay.ConditionTable(3)
+			for j in range(3):
+				table.setvalues[j] = rnd.randint(-10, 40)
+				table.clearvalues[j] = rnd.randint(-10, 40)
+				table.relays[j] = rnd.randint(-1, 5)
+				table.active[j] = rnd.randint(0, 1)
+			tables.append(('sensor{}'.format(i), table))
+
+		batch = dbus_tempsensor_relay.BatchEvaluator(use_numpy=use_numpy)
+		batch.attach(tables)
+
+		for step in range(20):
+			temperatures = [rnd.choice([None, rnd.uniform(-15, 45)]) for t in tables]
+			evaluate = [rnd.random() > 0.2 for t in tables]
+
+			# Scalar reference
+			expected = []
+			states = [False] * len(configured)
+			for (service, table), t, e in zip(tables, temperatures, evaluate):
+				active = list(table.active)
+				for j, r in enumerate(table.relays):
+					if r >= 0 and e:
+						ok = r < len(configured) and configured[r]
+						active[j] = bool(inRange(None, table.setvalues[j], table.clearvalues[j], t, active[j]) and ok)
+					if active[j] and r >= 0 and r < len(configured):
+						states[r] = True
+				expected.append(active)
+
+			for i, (t, e) in enumerate(zip(temperatures, evaluate)):
+				batch.temperatures[i] = float('nan') if t is None else t
+				batch.evaluate[i] = e
+			result = batch.update(configured)
+
+			self.assertEqual([bool(x) for x in result], states)
+			self.assertEqual([[bool(x) for x in table.active] for service, table in tables], expected)
+
+	def test_array_backend(self):
+		self._check_backend(False)
+
+	@unittest.skipIf(dbus_tempsensor_relay.load_numpy() is None, 'NumPy is not available')
+	def test_numpy_backend(self):
+		self._check_backend(True)
+
 
 if __name__ == '__main__':
 	# patch dbus_generator with mock glib